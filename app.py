@@ -1,3 +1,5 @@
+import os
+import tempfile
 import streamlit as st
 import pandas as pd
 from auth import verify_login, log_activity
@@ -6,16 +8,42 @@ import plotly.graph_objects as go
 from datetime import datetime, timedelta
 # Add these imports to app.py
 from privacy import (
-    get_patient_data,
+    get_patient_page,
     add_patient,
     anonymize_all_patients,
     encrypt_patient_data,
     decrypt_patient_data,
     set_retention_period,
     check_expired_data,
-    delete_expired_data
+    delete_expired_data,
+    erase_patient,
+    find_patients,
+    start_retention_sweeper,
+    retention_status,
+    retention_lag_days,
+    add_retention_policy,
+    get_retention_policies,
+    apply_retention_policies
 )
-import sqlite3
+from database import get_connection
+from jobs import encrypt_all_patients, start_key_rotation, rotation_status
+from audit import (
+    flush_audit_log,
+    get_access_history,
+    get_audit_log_page,
+    get_log_filter_options,
+    export_audit_logs,
+    LOG_PAGE_SIZE,
+    TARGET_PATIENT,
+    TARGET_USER
+)
+from cache import cached_query
+from integrity import verify_audit_log
+from migrations import run_migrations
+
+# Windows (days) offered on the activity chart
+ACTIVITY_WINDOWS = [7, 30, 90, 365]
+
 
 # Page configuration
 st.set_page_config(
@@ -24,6 +52,17 @@ st.set_page_config(
     layout="wide"
 )
 
+
+@st.cache_resource
+def init_database():
+    """Bring the schema up to date and start background jobs once per server process"""
+    run_migrations()
+    start_retention_sweeper()
+    return True
+
+
+init_database()
+
 # Initialize session state
 if 'logged_in' not in st.session_state:
     st.session_state.logged_in = False
@@ -86,29 +125,32 @@ def admin_dashboard():
     
     with tab1:
         st.subheader("All Patient Data (Full Access)")
-        data = get_patient_data('admin')
-        
-        if data:
-            df = pd.DataFrame(data)
-            st.dataframe(df, use_container_width=True)
-            st.info(f"📊 Total Patients: {len(df)}")
-        else:
-            st.warning("⚠️ No patient data available")
+        patient_search('admin')
+        show_patient_page('admin')
     
     with tab2:
         st.subheader("Anonymize Patient Data")
         
+        incremental = st.checkbox(
+            "Only new or changed records",
+            value=True,
+            help="Skip patients whose anonymized fields are already up to date"
+        )
+        
         if st.button('🎭 Anonymize All Patients', use_container_width=True):
-            with st.spinner('Anonymizing...'):
-                anonymize_all_patients()
-                log_activity(
-                    st.session_state.user['user_id'], 
-                    'admin', 
-                    'anonymize_all',
-                    'Anonymized all patient records'
-                )
-            st.success("✅ All patients anonymized!")
-            st.rerun()
+            progress_bar = st.progress(0.0, text='Anonymizing...')
+            
+            def show_progress(done, total, updated):
+                progress_bar.progress(done / total, text=f'Anonymizing... {updated} updated')
+            
+            count = anonymize_all_patients(incremental=incremental, progress=show_progress)
+            log_activity(
+                st.session_state.user['user_id'], 
+                'admin', 
+                'anonymize_all',
+                f'Anonymized {count} patient records'
+            )
+            st.success(f"✅ {count} patients anonymized!")
     
     with tab3:
         st.subheader("Audit Logs & Activity Analytics")
@@ -120,21 +162,37 @@ def admin_dashboard():
         
         # Show logs table
         st.subheader("Detailed Audit Logs")
-        logs = get_audit_logs()
-        
-        if not logs.empty:
-            st.dataframe(logs, use_container_width=True)
-            
-            csv = logs.to_csv(index=False)
-            st.download_button(
-                "📥 Download Logs",
-                csv,
-                "audit_logs.csv",
-                "text/csv"
-            )
-        else:
-            st.warning("No logs available")
-    
+        filters = audit_log_filters()
+        show_audit_log_page(filters)
+        audit_log_export(filters)
+
+        if st.button("🔏 Verify Log Integrity"):
+            flush_audit_log(timeout=2)
+            result = verify_audit_log()
+            if result['ok']:
+                st.success(f"✅ Audit log intact: {result['checked']} new events checked "
+                           f"in {result['seconds']:.2f}s")
+            else:
+                st.error(f"❌ Tampering detected: {result['error']}")
+
+        st.divider()
+
+        # GDPR access requests: who touched this patient's record
+        st.subheader("🔎 Patient Access History")
+        history_patient_id = st.number_input(
+            "Patient ID",
+            min_value=1,
+            step=1,
+            key="history_id"
+        )
+
+        if st.button("Show Access History"):
+            history = get_access_history(history_patient_id)
+            if history:
+                st.dataframe(pd.DataFrame(history), use_container_width=True)
+            else:
+                st.info(f"No recorded access to patient {history_patient_id}")
+
     with tab4:
         st.subheader("🔐 Fernet Encryption Management")
         st.write("Encrypt patient data using reversible Fernet encryption")
@@ -150,13 +208,18 @@ def admin_dashboard():
             )
             
             if st.button("🔒 Encrypt Patient Data"):
-                if encrypt_patient_data(patient_id_encrypt):
+                encrypted = encrypt_patient_data(patient_id_encrypt)
+                if encrypted is None:
+                    st.info(f"ℹ️ Patient {patient_id_encrypt} is already encrypted")
+                elif encrypted:
                     st.success(f"✅ Patient {patient_id_encrypt} data encrypted!")
                     log_activity(
                         st.session_state.user['user_id'],
                         'admin',
                         'encrypt_data',
-                        f'Encrypted patient {patient_id_encrypt}'
+                        f'Encrypted patient {patient_id_encrypt}',
+                        target_type=TARGET_PATIENT,
+                        target_id=patient_id_encrypt
                     )
                 else:
                     st.error("❌ Encryption failed!")
@@ -177,10 +240,65 @@ def admin_dashboard():
                         st.session_state.user['user_id'],
                         'admin',
                         'decrypt_data',
-                        f'Decrypted patient {patient_id_decrypt}'
+                        f'Decrypted patient {patient_id_decrypt}',
+                        durable=True,
+                        target_type=TARGET_PATIENT,
+                        target_id=patient_id_decrypt
                     )
                 else:
                     st.error("❌ Patient not found or decryption failed!")
+        
+        st.divider()
+        
+        # Bulk encryption (resumable)
+        st.write("### Bulk Encryption")
+        st.caption("Encrypts every patient record in parallel. An interrupted run resumes where it stopped.")
+        
+        if st.button("🔒 Encrypt All Patients", use_container_width=True):
+            progress_bar = st.progress(0.0, text='Encrypting...')
+            
+            def show_progress(done, total, encrypted, rate):
+                progress_bar.progress(done / total, text=f'Encrypting... {encrypted} rows ({rate:.0f} rows/s)')
+            
+            count = encrypt_all_patients(progress=show_progress)
+            log_activity(
+                st.session_state.user['user_id'],
+                'admin',
+                'encrypt_all',
+                f'Bulk encrypted {count} patients'
+            )
+            st.success(f"✅ Encrypted {count} patient records!")
+        
+        st.divider()
+        
+        # Key rotation (runs in the background, reads keep working)
+        st.write("### Key Rotation")
+        st.caption("Generates a new master key, re-wraps record data keys and re-encrypts legacy records in small batches in the background.")
+        
+        if rotation_status['running']:
+            total = rotation_status['total'] or 1
+            st.progress(
+                rotation_status['done'] / total,
+                text=f"Rotating to key v{rotation_status['key_version']}... "
+                     f"{rotation_status['rotated']} rows ({rotation_status['rows_per_sec']:.0f} rows/s)"
+            )
+            st.button("🔄 Refresh Status")
+        else:
+            if rotation_status['error']:
+                st.error(f"❌ Last rotation failed: {rotation_status['error']}")
+            elif rotation_status['key_version']:
+                st.success(f"✅ Rotated {rotation_status['rotated']} records to key v{rotation_status['key_version']}")
+            
+            if st.button("🔄 Rotate Encryption Key", use_container_width=True):
+                start_key_rotation()
+                log_activity(
+                    st.session_state.user['user_id'],
+                    'admin',
+                    'rotate_key',
+                    f"Started rotation to key version {rotation_status['key_version']}",
+                    durable=True
+                )
+                st.rerun()
     
     with tab5:
         st.subheader("⏰ GDPR Data Retention Management")
@@ -211,9 +329,58 @@ def admin_dashboard():
                     st.session_state.user['user_id'],
                     'admin',
                     'set_retention',
-                    f'Set retention for patient {patient_id_retention}: {retention_days} days'
+                    f'Set retention for patient {patient_id_retention}: {retention_days} days',
+                    target_type=TARGET_PATIENT,
+                    target_id=patient_id_retention
                 )
-        
+
+        st.divider()
+
+        # Retention policies (applied to every matching record)
+        st.write("### Retention Policies")
+        policies = get_retention_policies()
+        if policies:
+            st.dataframe(pd.DataFrame(policies), use_container_width=True)
+        else:
+            st.info("No retention policies yet - new records get no retention date")
+
+        with st.form("retention_policy_form"):
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                policy_name = st.text_input("Policy Name", placeholder="e.g., fractures")
+            with col2:
+                policy_pattern = st.text_input("Diagnosis Pattern", placeholder="e.g., %fracture% (blank = all)")
+            with col3:
+                policy_days = st.number_input("Keep for (days after admission)", min_value=1, value=3650, step=30)
+            with col4:
+                policy_priority = st.number_input("Priority", value=0, step=1)
+            save_policy = st.form_submit_button("💾 Save Policy")
+
+        if save_policy and policy_name:
+            add_retention_policy(policy_name, policy_days, policy_pattern, policy_priority)
+            log_activity(
+                st.session_state.user['user_id'],
+                'admin',
+                'set_retention_policy',
+                f'Policy {policy_name}: {policy_pattern or "all"} -> {policy_days} days (priority {policy_priority})'
+            )
+            st.rerun()
+
+        if st.button("⚙️ Apply Policies to All Records", use_container_width=True):
+            progress_bar = st.progress(0.0, text='Applying policies...')
+
+            def show_progress(done, total, updated):
+                progress_bar.progress(done / total, text=f'Applying policies... {updated} updated')
+
+            count = apply_retention_policies(progress=show_progress)
+            log_activity(
+                st.session_state.user['user_id'],
+                'admin',
+                'apply_retention_policies',
+                f'Updated retention dates of {count} patients'
+            )
+            st.success(f"✅ Retention dates updated for {count} patients")
+
         st.divider()
         
         # Check expired data
@@ -231,6 +398,18 @@ def admin_dashboard():
         
         # Delete expired data
         st.write("### Delete Expired Data")
+        st.caption("Expired records are also deleted automatically by the background retention sweeper.")
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("Days Behind Policy", retention_lag_days())
+        with col2:
+            st.metric("Last Sweep", retention_status['last_run'] or "Not yet")
+        with col3:
+            st.metric("Last Sweep Rate", f"{retention_status['deleted']} rows · {retention_status['rows_per_sec']:.0f}/s")
+        if retention_status['error']:
+            st.error(f"❌ Last sweep failed: {retention_status['error']}")
+        
         st.error("⚠️ **Warning:** This action is irreversible!")
         
         if st.button("🗑️ Delete Expired Records", type="primary"):
@@ -241,10 +420,31 @@ def admin_dashboard():
                     st.session_state.user['user_id'],
                     'admin',
                     'delete_expired',
-                    f'Deleted {count} expired patient records'
+                    f'Deleted {count} expired patient records',
+                    durable=True
                 )
             else:
                 st.info("No records to delete")
+        
+        st.divider()
+        
+        # Right to be forgotten (crypto-shredding)
+        st.write("### Right to be Forgotten")
+        st.caption("Destroys the patient's encryption key, making every copy of their data unreadable, then removes the record.")
+        
+        patient_id_erase = st.number_input(
+            "Patient ID to Erase",
+            min_value=1,
+            step=1,
+            key="erase_id"
+        )
+        confirm_erase = st.checkbox(f"I confirm erasure of patient {patient_id_erase}")
+        
+        if st.button("🧨 Erase Patient", type="primary", disabled=not confirm_erase):
+            if erase_patient(patient_id_erase, st.session_state.user['user_id']):
+                st.success(f"✅ Patient {patient_id_erase} erased")
+            else:
+                st.error("❌ Patient not found!")
 
 
 def doctor_dashboard():
@@ -254,18 +454,10 @@ def doctor_dashboard():
     st.title("👨‍⚕️ Doctor Dashboard")
     st.subheader("Anonymized Patient Records with Diagnosis")
     
-    # Get anonymized patient data with diagnosis
-    data = get_patient_data('doctor')
-    
-    if data:
-        df = pd.DataFrame(data)
-        st.dataframe(df, use_container_width=True)
-        st.info(f"📊 Total Patients: {len(df)}")
-        
+    # Get anonymized patient data with diagnosis, one page at a time
+    if show_patient_page('doctor'):
         # Show information about data access
         st.info("ℹ️ **Privacy Note:** You are viewing anonymized patient identifiers. Real names and contacts are hidden for privacy protection.")
-    else:
-        st.warning("⚠️ No patient data available")
 
 
 def receptionist_dashboard():
@@ -279,15 +471,9 @@ def receptionist_dashboard():
     
     with tab1:
         st.subheader("Patient Records (Limited Access)")
-        data = get_patient_data('receptionist')
-        
-        if data:
-            df = pd.DataFrame(data)
-            st.dataframe(df, use_container_width=True)
-            st.info(f"📊 Total Patients: {len(df)}")
+        patient_search('receptionist')
+        if show_patient_page('receptionist'):
             st.warning("⚠️ **Privacy Note:** Diagnosis information is hidden for privacy compliance.")
-        else:
-            st.warning("⚠️ No patient data available")
     
     with tab2:
         st.subheader("Add New Patient")
@@ -316,67 +502,247 @@ def receptionist_dashboard():
                     st.error("❌ Please fill in all required fields!")
 
 
-def get_audit_logs():
+def show_patient_page(role):
+    """
+    Render one page of patient records with Prev/Next navigation
+    Returns: True if any records were shown
+    """
+    # Stack of keyset cursors: the last entry is the current page's cursor
+    state_key = f"page_cursors_{role}"
+    if state_key not in st.session_state:
+        st.session_state[state_key] = [None]
+    cursors = st.session_state[state_key]
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        page_size = st.selectbox("Rows per page", [25, 50, 100, 250], index=1, key=f"page_size_{role}")
+    with col2:
+        newest_first = st.toggle("Newest first", key=f"newest_first_{role}",
+                                 on_change=lambda: st.session_state.update({state_key: [None]}))
+    
+    page = get_patient_page(role, cursor=cursors[-1], page_size=page_size, descending=newest_first)
+    
+    if not page['rows']:
+        st.warning("⚠️ No patient data available")
+        return False
+    
+    st.dataframe(pd.DataFrame(page['rows']), use_container_width=True)
+    
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if st.button("⬅️ Previous", disabled=len(cursors) == 1, key=f"prev_{role}"):
+            cursors.pop()
+            st.rerun()
+    with col2:
+        st.caption(f"Page {len(cursors)} · ~{page['total_estimate']} patients in total")
+    with col3:
+        if st.button("Next ➡️", disabled=page['next_cursor'] is None, key=f"next_{role}"):
+            cursors.append(page['next_cursor'])
+            st.rerun()
+    
+    return True
+
+
+def patient_search(role):
+    """
+    Exact-match patient lookup by name and/or phone (works on encrypted records)
+    """
+    with st.expander("🔍 Find Patient"):
+        with st.form(f"search_form_{role}"):
+            col1, col2 = st.columns(2)
+            with col1:
+                name = st.text_input("Full Name", placeholder="e.g., John Doe")
+            with col2:
+                contact = st.text_input("Contact Number", placeholder="e.g., 0300-1234567")
+            submit = st.form_submit_button("🔍 Search")
+        
+        if submit:
+            if name or contact:
+                results = find_patients(role, name=name, contact=contact,
+                                        user_id=st.session_state.user['user_id'])
+                if results:
+                    st.dataframe(pd.DataFrame(results), use_container_width=True)
+                else:
+                    st.info("No matching patients found")
+            else:
+                st.warning("⚠️ Enter a name or contact number")
+
+
+def audit_log_filters():
     """
-    Fetch audit logs from database
-    Returns: DataFrame
+    Render the audit log filter controls
+    Returns: Dictionary of filters for get_audit_logs
     """
-    conn = sqlite3.connect('hospital.db')
+    roles, actions = get_log_filter_options()
+    
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        user_id = st.number_input("User ID (0 = all)", min_value=0, step=1, key="log_user_id")
+    with col2:
+        role = st.selectbox("Role", ["All"] + roles, key="log_role")
+    with col3:
+        action = st.selectbox("Action", ["All"] + actions, key="log_action")
+    with col4:
+        dates = st.date_input("Date range", value=(), key="log_dates")
+    
+    return {
+        'user_id': user_id or None,
+        'role': None if role == "All" else role,
+        'action': None if action == "All" else action,
+        'date_from': dates[0].isoformat() if len(dates) > 0 else None,
+        'date_to': dates[-1].isoformat() if len(dates) > 1 else None
+    }
+
+
+def show_audit_log_page(filters):
+    """
+    Render one page of filtered audit logs with Prev/Next navigation
+    """
+    # Stack of keyset cursors, reset whenever the filters change
+    state = st.session_state.get('log_cursors')
+    if state is None or state['filters'] != filters:
+        state = st.session_state['log_cursors'] = {'filters': filters, 'stack': [None]}
+    cursors = state['stack']
+    
+    logs, next_cursor = get_audit_logs(cursors[-1], **filters)
+    
+    if logs.empty:
+        st.warning("No logs available")
+        return
+    
+    st.dataframe(logs, use_container_width=True)
+    
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if st.button("⬅️ Previous", disabled=len(cursors) == 1, key="log_prev"):
+            cursors.pop()
+            st.rerun()
+    with col2:
+        st.caption(f"Page {len(cursors)}")
+    with col3:
+        if st.button("Next ➡️", disabled=next_cursor is None, key="log_next"):
+            cursors.append(next_cursor)
+            st.rerun()
+
+
+def audit_log_export(filters):
+    """
+    Export the filtered audit log as CSV or gzip
+    Rows are streamed from the database cursor and the archive segments
+    into a temporary file, never built up as a DataFrame. Only the file
+    path is kept in the session; the download button reads from the file,
+    which is deleted once the download has been served.
+    """
+    col1, col2 = st.columns(2)
+    with col1:
+        compress = st.toggle("Gzip export", value=True, key="log_export_gzip")
+    with col2:
+        prepare = st.button("📦 Prepare Export", key="log_export")
+    
+    if prepare:
+        discard_log_export()
+        suffix = '.csv.gz' if compress else '.csv'
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+            export_path = f.name
+        try:
+            export_audit_logs(export_path, compress=compress, **filters)
+        except Exception:
+            os.remove(export_path)
+            raise
+        st.session_state['log_export_file'] = (export_path, suffix)
+        st.caption(f"Export ready ({os.path.getsize(export_path) / 1024:.0f} KB)")
+    
+    export = st.session_state.get('log_export_file')
+    if export and os.path.exists(export[0]):
+        export_path, suffix = export
+        with open(export_path, 'rb') as f:
+            served = st.download_button(
+                "📥 Download Logs",
+                f,
+                f"audit_logs{suffix}",
+                "application/gzip" if suffix.endswith('.gz') else "text/csv"
+            )
+        if served:
+            discard_log_export()
+
+
+def discard_log_export():
+    """Delete the prepared audit log export, if any"""
+    export = st.session_state.pop('log_export_file', None)
+    if export and os.path.exists(export[0]):
+        os.remove(export[0])
+
+
+def get_audit_logs(cursor=None, page_size=LOG_PAGE_SIZE, **filters):
+    """
+    Fetch one page of audit logs from database
+    Returns: (DataFrame, next_cursor)
+    """
+    # Make sure events still queued in the audit writer are visible
+    flush_audit_log(timeout=2)
     
     try:
-        query = """
-            SELECT log_id, user_id, role, action, timestamp, details
-            FROM logs
-            ORDER BY timestamp DESC
-        """
-        df = pd.read_sql_query(query, conn)
-        return df
+        page = load_audit_logs(cursor, page_size, **filters)
+        return pd.DataFrame(page['rows']), page['next_cursor']
     except Exception as e:
         st.error(f"Error fetching logs: {str(e)}")
-        return pd.DataFrame()
-    finally:
-        conn.close()
+        return pd.DataFrame(), None
+
+
+@cached_query
+def load_audit_logs(cursor, page_size, **filters):
+    """Audit log page query (cached until the database changes)"""
+    return get_audit_log_page(cursor, page_size, **filters)
 
 
 def logout():
     """
     Clear session and logout user
     """
+    discard_log_export()
     st.session_state.logged_in = False
     st.session_state.user = None
     st.rerun()
 
 
 
-def get_activity_stats():
+def get_activity_stats(days=7):
     """
     Get activity statistics for visualization
-    Returns: DataFrame with daily activity counts
+    Returns: DataFrame with daily activity counts for the last `days` days
     """
-    conn = sqlite3.connect('hospital.db')
-    
-    try:
-        query = """
-            SELECT 
-                DATE(timestamp) as date,
-                action,
-                COUNT(*) as count
-            FROM logs
-            WHERE timestamp >= date('now', '-7 days')
-            GROUP BY DATE(timestamp), action
-            ORDER BY date DESC
-        """
-        df = pd.read_sql_query(query, conn)
-        return df
-    finally:
-        conn.close()
+    flush_audit_log(timeout=2)
+    return load_activity_stats(days)
+
+
+@cached_query
+def load_activity_stats(days):
+    """Activity statistics from the rollup table (cost independent of log volume)"""
+    query = """
+        SELECT 
+            day as date,
+            action,
+            SUM(count) as count
+        FROM activity_rollup
+        WHERE day >= date('now', ?)
+        GROUP BY day, action
+        ORDER BY date DESC
+    """
+    df = pd.read_sql_query(query, get_connection(), params=(f'-{days} days',))
+    return df
 
 
 def display_activity_chart():
     """Display real-time activity chart"""
-    st.subheader("📊 User Activity (Last 7 Days)")
+    days = st.selectbox(
+        "Activity window",
+        ACTIVITY_WINDOWS,
+        format_func=lambda d: f"Last {d} days",
+        key="activity_window"
+    )
+    st.subheader(f"📊 User Activity (Last {days} Days)")
     
-    df = get_activity_stats()
+    df = get_activity_stats(days)
     
     if not df.empty:
         # Create bar chart
@@ -387,7 +753,7 @@ def display_activity_chart():
             color='action',
             title='Daily Activity by Action Type',
             labels={'count': 'Number of Actions', 'date': 'Date'},
-            barmode='group'
+            barmode='group' if days <= 7 else 'stack'
         )
         
         st.plotly_chart(fig, use_container_width=True)
@@ -407,7 +773,7 @@ def display_activity_chart():
             avg_per_day = total_actions / unique_days if unique_days > 0 else 0
             st.metric("Avg Actions/Day", f"{avg_per_day:.1f}")
     else:
-        st.info("No activity data available for the last 7 days")
+        st.info(f"No activity data available for the last {days} days")
 
 
 def show_gdpr_consent_banner():
@@ -478,7 +844,9 @@ def main():
                     st.session_state.user['user_id'],
                     st.session_state.user['role'],
                     'logout',
-                    f"User {st.session_state.user['username']} logged out"
+                    f"User {st.session_state.user['username']} logged out",
+                    target_type=TARGET_USER,
+                    target_id=st.session_state.user['user_id']
                 )
                 logout()
             
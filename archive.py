@@ -0,0 +1,168 @@
+import gzip
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from database import get_connection, transaction, iter_rows
+
+# Audit log rows older than this many days move to archive segments
+LOG_ARCHIVE_AGE_DAYS = 365
+LOG_ARCHIVE_DIR = 'log_archive'
+
+# Columns stored per archived event (one JSON object per line)
+ARCHIVE_COLUMNS = ['log_id', 'user_id', 'role', 'action', 'timestamp',
+                   'details', 'target_type', 'target_id', 'ts_ms', 'entry_hash']
+
+
+def _month_start_ms(year, month):
+    return int(datetime(year, month, 1, tzinfo=timezone.utc).timestamp()) * 1000
+
+
+def _next_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def _archive_cutoff_ms(max_age_days):
+    """Start of the month containing now - max_age_days: only whole months are archived"""
+    now_ms = int(datetime.now(timezone.utc).timestamp()) * 1000
+    oldest = datetime.fromtimestamp((now_ms - max_age_days * 86_400_000) / 1000, timezone.utc)
+    return _month_start_ms(oldest.year, oldest.month)
+
+
+def _write_segment(path, rows):
+    """
+    Write rows to a gzip JSONL file atomically
+    Returns: (row count, sha256 of the file, targets seen)
+    """
+    tmp_path = path + '.tmp'
+    count = 0
+    targets = set()
+
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        for row in rows:
+            record = dict(zip(ARCHIVE_COLUMNS, row))
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+            count += 1
+            if record['target_id'] is not None:
+                targets.add((record['target_type'], record['target_id']))
+
+    digest = hashlib.sha256()
+    with open(tmp_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return count, digest.hexdigest(), targets
+
+
+def archive_audit_logs(max_age_days=LOG_ARCHIVE_AGE_DAYS, archive_dir=LOG_ARCHIVE_DIR):
+    """
+    Move audit events older than max_age_days into monthly segment files
+    Each segment is an immutable gzip JSONL file listed in the
+    log_archive_segments manifest; the live rows are deleted in the same
+    transaction that records the segment, so an interrupted run leaves
+    at worst an unlisted file that the next run overwrites. Only events
+    up to the last verified integrity checkpoint are archived.
+    The activity rollup keeps counting archived events.
+
+    Returns: Number of events archived
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    cutoff_ms = _archive_cutoff_ms(max_age_days)
+    conn = get_connection()
+    archived = 0
+
+    # Only events the integrity check has already covered leave the table
+    verified_log_id = conn.execute(
+        "SELECT COALESCE(MAX(log_id), 0) FROM audit_checkpoints WHERE verified_at IS NOT NULL"
+    ).fetchone()[0]
+
+    while True:
+        oldest_ms, max_log_id = conn.execute(
+            "SELECT MIN(ts_ms), MAX(log_id) FROM log_events WHERE ts_ms < ? AND log_id <= ?",
+            (cutoff_ms, verified_log_id)
+        ).fetchone()
+        if oldest_ms is None:
+            break
+
+        oldest = datetime.fromtimestamp(oldest_ms / 1000, timezone.utc)
+        start_ms = _month_start_ms(oldest.year, oldest.month)
+        end_ms = _month_start_ms(*_next_month(oldest.year, oldest.month))
+        month = oldest.strftime('%Y-%m')
+
+        first_log_id = conn.execute(
+            "SELECT MIN(log_id) FROM log_events WHERE ts_ms >= ? AND ts_ms < ? AND log_id <= ?",
+            (start_ms, end_ms, max_log_id)
+        ).fetchone()[0]
+        path = os.path.join(archive_dir, f"logs-{month}-{first_log_id}.jsonl.gz")
+
+        # Same bounds for the copy and the delete: rows that arrive
+        # meanwhile stay live and go into a later segment
+        bounds = (start_ms, end_ms, max_log_id)
+        rows = iter_rows(f"""
+            SELECT {', '.join('l.' + column for column in ARCHIVE_COLUMNS[:-1])}, e.entry_hash
+            FROM logs l
+            JOIN log_events e USING (log_id)
+            WHERE l.ts_ms >= ? AND l.ts_ms < ? AND l.log_id <= ?
+            ORDER BY l.log_id
+        """, bounds)
+        count, sha256, targets = _write_segment(path, (tuple(row) for row in rows))
+
+        with transaction() as conn:
+            cursor = conn.execute("""
+                INSERT INTO log_archive_segments
+                    (month, path, first_ts, last_ts, row_count, sha256)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (month, path, start_ms, end_ms - 1, count, sha256))
+            conn.executemany("""
+                INSERT OR IGNORE INTO log_archive_targets (target_type, target_id, segment_id)
+                VALUES (?, ?, ?)
+            """, [(target_type, target_id, cursor.lastrowid) for target_type, target_id in targets])
+            conn.execute(
+                "DELETE FROM log_events WHERE ts_ms >= ? AND ts_ms < ? AND log_id <= ?", bounds
+            )
+
+        archived += count
+        print(f"📦 Archived {count} events from {month} to {path}")
+
+    return archived
+
+
+def find_segments(ts_from=None, ts_to=None, target=None):
+    """
+    Manifest lookup: segments that can hold matching events, newest first
+    ts_from/ts_to are epoch-ms bounds (inclusive/exclusive); target is a
+    (target_type, target_id) pair.
+
+    Returns: List of (path, first_ts, last_ts)
+    """
+    conditions = []
+    params = []
+
+    if ts_from is not None:
+        conditions.append("s.last_ts >= ?")
+        params.append(ts_from)
+    if ts_to is not None:
+        conditions.append("s.first_ts < ?")
+        params.append(ts_to)
+    if target is not None:
+        conditions.append("""s.segment_id IN (
+            SELECT segment_id FROM log_archive_targets
+            WHERE target_type = ? AND target_id = ?
+        )""")
+        params.extend(target)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return get_connection().execute(f"""
+        SELECT s.path, s.first_ts, s.last_ts
+        FROM log_archive_segments s
+        {where}
+        ORDER BY s.last_ts DESC, s.segment_id DESC
+    """, params).fetchall()
+
+
+def iter_segment(path):
+    """Stream one archive segment as dictionaries (log_id order)"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
@@ -0,0 +1,549 @@
+import atexit
+import csv
+import heapq
+import io
+import queue
+import zlib
+from collections import Counter
+from itertools import groupby, islice
+from operator import itemgetter
+import threading
+import time
+from datetime import datetime, timezone
+from database import (
+    get_connection, transaction, iter_rows, row_type,
+    close_connection, close_all_connections, STREAM_CHUNK_SIZE
+)
+from archive import find_segments, iter_segment
+from integrity import chain_events
+
+# Group-commit tuning
+AUDIT_BATCH_SIZE = 200          # commit after this many events...
+AUDIT_FLUSH_INTERVAL_MS = 250   # ...or after this long, whichever comes first
+AUDIT_QUEUE_SIZE = 10000        # callers block once this many events are pending
+AUDIT_PUT_TIMEOUT = 2.0         # seconds to wait on a full queue before writing inline
+AUDIT_WRITE_RETRIES = 3
+
+# Audit log viewer
+LOG_PAGE_SIZE = 100
+MAX_LOG_PAGE_SIZE = 1000
+EXPORT_COLUMNS = ['log_id', 'user_id', 'role', 'action', 'timestamp', 'details', 'target_type', 'target_id']
+
+# log_events.target_type values
+TARGET_PATIENT = 'patient'
+TARGET_USER = 'user'
+
+_FLUSH = object()
+_STOP = object()
+
+# Actions and roles are stored once in lookup tables; events hold their ids
+INSERT_ACTION_SQL = "INSERT OR IGNORE INTO log_actions (name) VALUES (?)"
+INSERT_ROLE_SQL = "INSERT OR IGNORE INTO log_roles (name) VALUES (?)"
+INSERT_LOG_SQL = """
+    INSERT INTO log_events (log_id, user_id, role_id, action_id, ts_ms, details,
+                            target_type, target_id, entry_hash)
+    VALUES (
+        ?, ?,
+        (SELECT role_id FROM log_roles WHERE name = ?),
+        (SELECT action_id FROM log_actions WHERE name = ?),
+        ?, ?, ?, ?, ?
+    )
+"""
+
+# Pre-aggregated counts for the activity chart, kept in step with logs
+UPSERT_ROLLUP_SQL = """
+    INSERT INTO activity_rollup (day, hour, action, role, count)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (day, hour, action, role) DO UPDATE SET count = count + excluded.count
+"""
+
+
+def _epoch_ms():
+    """Current time as integer milliseconds since the Unix epoch"""
+    return time.time_ns() // 1_000_000
+
+
+def rollup_counts(rows):
+    """Aggregate audit rows into (day, hour, action, role, count) tuples"""
+    counts = Counter()
+    for _, role, action, ts_ms, *_ in rows:
+        moment = datetime.fromtimestamp(ts_ms / 1000, timezone.utc)
+        counts[(moment.strftime('%Y-%m-%d'), moment.hour, action, role)] += 1
+    return [key + (count,) for key, count in counts.items()]
+
+
+def write_events(rows):
+    """
+    Insert audit rows on the calling thread (joins any open transaction)
+    Each event is hash-chained to the previous one (see integrity.py).
+    The activity rollup is updated in the same transaction, one upsert
+    per (day, hour, action, role) group rather than one per event.
+    """
+    with transaction() as conn:
+        conn.executemany(INSERT_ROLE_SQL, [(role,) for role in {row[1] for row in rows}])
+        conn.executemany(INSERT_ACTION_SQL, [(action,) for action in {row[2] for row in rows}])
+        conn.executemany(INSERT_LOG_SQL, chain_events(conn, rows))
+        conn.executemany(UPSERT_ROLLUP_SQL, rollup_counts(rows))
+
+
+class _Waiter:
+    """Lets a submitter block until its batch is written, and see if that failed"""
+
+    def __init__(self):
+        self.error = None
+        self._event = threading.Event()
+
+    def release(self, error=None):
+        self.error = error
+        self._event.set()
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+
+class AuditWriter:
+    """
+    Background audit-log writer
+    Events are queued in memory and a dedicated thread inserts them with
+    executemany, committing once per batch instead of once per event.
+    """
+
+    def __init__(self, batch_size=AUDIT_BATCH_SIZE,
+                 flush_interval_ms=AUDIT_FLUSH_INTERVAL_MS,
+                 max_queue=AUDIT_QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start the writer thread (no-op if already running)"""
+        with self._lock:
+            if not self.running:
+                self._thread = threading.Thread(
+                    target=self._run, name="audit-writer", daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, user_id, role, action, details="", durable=False,
+               target_type=None, target_id=None):
+        """
+        Queue one audit event
+        durable=True blocks until the event is committed and synced to disk,
+        and raises the writer's error if the event could not be committed.
+        """
+        row = (user_id, role, action, _epoch_ms(), details, target_type, target_id)
+
+        # Inside a caller's transaction the writer thread could not get the
+        # write lock until we commit, so durable events join that transaction
+        if not self.running or (durable and get_connection().in_transaction):
+            write_events([row])
+            return
+
+        done = _Waiter() if durable else None
+        try:
+            # Blocks while the queue is full (backpressure on producers)
+            self._queue.put((row, done), timeout=AUDIT_PUT_TIMEOUT)
+        except queue.Full:
+            write_events([row])
+            return
+
+        if done is not None:
+            done.wait()
+            if done.error is not None:
+                raise done.error
+
+    def flush(self, timeout=None):
+        """
+        Wait until every event queued so far has been written
+        Returns: False on timeout or if a batch could not be committed
+        """
+        if not self.running:
+            return True
+        done = _Waiter()
+        self._queue.put((_FLUSH, done))
+        return done.wait(timeout) and done.error is None
+
+    def stop(self):
+        """Flush pending events and stop the writer thread"""
+        if not self.running:
+            return
+        self._queue.put((_STOP, None))
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+
+            # Collect more events until the batch is full, the interval
+            # expires, or someone is waiting on the result
+            while len(batch) < self.batch_size and batch[-1][1] is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            rows = [item for item, _ in batch if item is not _FLUSH and item is not _STOP]
+            durable = any(done is not None and item is not _FLUSH for item, done in batch)
+            stopping = any(item is _STOP for item, _ in batch)
+
+            error = self._write_batch(rows, durable) if rows else None
+
+            # Only release waiters once their events are committed (or lost)
+            for _, done in batch:
+                if done is not None:
+                    done.release(error)
+
+        # Drain anything that raced in behind the stop marker
+        leftover = []
+        waiters = []
+        while True:
+            try:
+                item, done = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _FLUSH and item is not _STOP:
+                leftover.append(item)
+            if done is not None:
+                waiters.append(done)
+        error = self._write_batch(leftover, True) if leftover else None
+        for done in waiters:
+            done.release(error)
+        close_connection()
+
+    def _write_batch(self, rows, durable):
+        """
+        Write one batch, retrying transient failures
+        Returns: None on success, or the last exception once every retry failed
+        """
+        conn = get_connection()
+        if durable:
+            conn.execute("PRAGMA synchronous = FULL")
+        try:
+            for attempt in range(1, AUDIT_WRITE_RETRIES + 1):
+                try:
+                    write_events(rows)
+                    return None
+                except Exception as e:
+                    if attempt == AUDIT_WRITE_RETRIES:
+                        print(f"❌ Audit writer dropped {len(rows)} events: {e}")
+                        return e
+                    time.sleep(0.1 * attempt)
+        finally:
+            if durable:
+                conn.execute("PRAGMA synchronous = NORMAL")
+
+
+_writer = AuditWriter()
+
+
+def iter_audit_logs(chunk_size=STREAM_CHUNK_SIZE, chunked=False, **filters):
+    """
+    Stream audit logs, newest first
+    Yields compact LogRow namedtuples (or lists of them when chunked=True)
+    without loading the whole table. Accepts the same filters as
+    get_audit_log_page, and like it continues into the archive segments.
+    """
+    flush_audit_log(timeout=2)
+    conditions, params = _log_filters(**filters)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = f"""
+        SELECT {', '.join(EXPORT_COLUMNS)}, ts_ms
+        FROM logs
+        {where}
+        ORDER BY ts_ms DESC, log_id DESC
+    """
+    make_row = row_type('LogRow', EXPORT_COLUMNS)._make
+
+    live = (((row.ts_ms, row.log_id), make_row(row[:-1]))
+            for row in iter_rows(query, params, chunk_size))
+    archived = (((record['ts_ms'], record['log_id']), make_row(record[c] for c in EXPORT_COLUMNS))
+                for record in _iter_archive(**filters))
+    rows = (row for _, row in heapq.merge(live, archived, key=itemgetter(0), reverse=True))
+
+    if not chunked:
+        return rows
+    return iter(lambda: list(islice(rows, chunk_size)), [])
+
+
+def _day_start_ms(day):
+    """'YYYY-MM-DD' (UTC) to epoch milliseconds"""
+    moment = datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    return int(moment.timestamp()) * 1000
+
+
+def _log_filters(user_id=None, role=None, action=None, date_from=None, date_to=None):
+    """
+    WHERE conditions for the audit log filters
+    Dates are inclusive 'YYYY-MM-DD' (UTC) and become ts_ms ranges, so
+    every filter can be served from the log_events indexes.
+    """
+    conditions = []
+    params = []
+
+    if user_id is not None:
+        conditions.append("user_id = ?")
+        params.append(user_id)
+    if role:
+        conditions.append("role = ?")
+        params.append(role)
+    if action:
+        conditions.append("action = ?")
+        params.append(action)
+    if date_from:
+        conditions.append("ts_ms >= ?")
+        params.append(_day_start_ms(date_from))
+    if date_to:
+        conditions.append("ts_ms < ?")
+        params.append(_day_start_ms(date_to) + 86_400_000)
+
+    return conditions, params
+
+
+def _archive_filter(cursor=None, target=None, user_id=None, role=None,
+                    action=None, date_from=None, date_to=None):
+    """
+    Archive equivalent of _log_filters
+    Returns: (ts_from, ts_to, matches) - epoch-ms bounds for the manifest
+    lookup and a predicate for archived records
+    """
+    ts_from = _day_start_ms(date_from) if date_from else None
+    ts_to = _day_start_ms(date_to) + 86_400_000 if date_to else None
+    if cursor is not None:
+        ts_to = min(ts_to, cursor[0] + 1) if ts_to is not None else cursor[0] + 1
+
+    def matches(record):
+        key = (record['ts_ms'], record['log_id'])
+        return ((cursor is None or key < tuple(cursor))
+                and (ts_from is None or record['ts_ms'] >= ts_from)
+                and (ts_to is None or record['ts_ms'] < ts_to)
+                and (user_id is None or record['user_id'] == user_id)
+                and (not role or record['role'] == role)
+                and (not action or record['action'] == action)
+                and (target is None or (record['target_type'], record['target_id']) == tuple(target)))
+
+    return ts_from, ts_to, matches
+
+
+def _search_archive(limit, cursor=None, target=None, **filters):
+    """
+    Newest `limit` archived events matching the filters (and below cursor)
+    Only segments whose manifest entry can match are opened, newest
+    first, and scanning stops once older segments can't make the cut.
+    Returns: List of dictionaries, newest first
+    """
+    ts_from, ts_to, matches = _archive_filter(cursor, target, **filters)
+
+    best = []    # min-heap of the newest `limit` matches
+    for path, first_ts, last_ts in find_segments(ts_from, ts_to, target):
+        if len(best) >= limit and last_ts < best[0][0][0]:
+            break
+        for record in iter_segment(path):
+            if matches(record):
+                item = ((record['ts_ms'], record['log_id']), record)
+                if len(best) < limit:
+                    heapq.heappush(best, item)
+                elif item[0] > best[0][0]:
+                    heapq.heapreplace(best, item)
+
+    return [record for _, record in sorted(best, key=lambda item: item[0], reverse=True)]
+
+
+def _iter_archive(**filters):
+    """
+    Every archived event matching the filters, newest first
+    Segments cover whole months, so one month's matches at a time are
+    sorted in memory - never the whole archive.
+    """
+    ts_from, ts_to, matches = _archive_filter(**filters)
+    segments = find_segments(ts_from, ts_to)
+
+    for _, month in groupby(segments, key=itemgetter(1)):
+        records = [record for path, _, _ in month for record in iter_segment(path) if matches(record)]
+        records.sort(key=lambda record: (record['ts_ms'], record['log_id']), reverse=True)
+        yield from records
+
+
+def get_audit_log_page(cursor=None, page_size=LOG_PAGE_SIZE, **filters):
+    """
+    Fetch one page of audit logs, newest first
+    Keyset pagination on (ts_ms, log_id): pass the previous page's
+    next_cursor to get the following page. Filters: user_id, role,
+    action, date_from, date_to. Pages continue from the live table
+    into the archive segments.
+
+    Returns: Dictionary with rows (list of dicts) and next_cursor (None
+    on the last page)
+    """
+    flush_audit_log(timeout=2)
+    page_size = max(1, min(page_size, MAX_LOG_PAGE_SIZE))
+    conditions, params = _log_filters(**filters)
+
+    if cursor is not None:
+        conditions.append("(ts_ms, log_id) < (?, ?)")
+        params.extend(cursor)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    # Fetch one extra row to know whether another page follows
+    rows = get_connection().execute(f"""
+        SELECT {', '.join(EXPORT_COLUMNS)}, ts_ms
+        FROM logs
+        {where}
+        ORDER BY ts_ms DESC, log_id DESC
+        LIMIT ?
+    """, params + [page_size + 1]).fetchall()
+    rows = [dict(zip(EXPORT_COLUMNS + ['ts_ms'], row)) for row in rows]
+
+    # Live table exhausted: continue with archived (older) events
+    if len(rows) <= page_size:
+        archive_cursor = (rows[-1]['ts_ms'], rows[-1]['log_id']) if rows else cursor
+        rows += _search_archive(page_size + 1 - len(rows), archive_cursor, **filters)
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    return {
+        'rows': [{column: row[column] for column in EXPORT_COLUMNS} for row in rows],
+        'next_cursor': (rows[-1]['ts_ms'], rows[-1]['log_id']) if has_more else None
+    }
+
+
+def get_log_filter_options():
+    """
+    Distinct roles and actions for the viewer's filter dropdowns
+    Returns: (roles, actions) - read from the small lookup tables
+    """
+    conn = get_connection()
+    roles = [row[0] for row in conn.execute("SELECT name FROM log_roles ORDER BY name")]
+    actions = [row[0] for row in conn.execute("SELECT name FROM log_actions ORDER BY name")]
+    return roles, actions
+
+
+def iter_audit_log_csv(compress=False, chunk_size=STREAM_CHUNK_SIZE, **filters):
+    """
+    Stream the (filtered) audit log as CSV
+    Yields bytes one chunk of rows at a time, gzip-compressed when
+    compress=True, so memory stays constant however big the log is.
+    """
+    gzip = zlib.compressobj(wbits=31) if compress else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def drain():
+        data = buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+        return gzip.compress(data) if gzip else data
+
+    writer.writerow(EXPORT_COLUMNS)
+    yield drain()
+
+    for rows in iter_audit_logs(chunk_size, chunked=True, **filters):
+        writer.writerows(rows)
+        yield drain()
+
+    if gzip:
+        yield gzip.flush()
+
+
+def export_audit_logs(path, compress=None, **filters):
+    """
+    Write the (filtered) audit log to a CSV file, chunk by chunk
+    Archived events are included. compress defaults to True for paths
+    ending in .gz.
+    Returns: Number of bytes written
+    """
+    if compress is None:
+        compress = path.endswith('.gz')
+
+    written = 0
+    with open(path, 'wb') as f:
+        for data in iter_audit_log_csv(compress=compress, **filters):
+            f.write(data)
+            written += len(data)
+    return written
+
+
+def get_access_history(patient_id, limit=None):
+    """
+    Everyone who touched a patient's record, newest first
+    Served from the (target_type, target_id, ts_ms) index, plus only the
+    archive segments whose manifest lists this patient, so the cost
+    depends on the patient's history, not on the size of the log.
+    Returns: List of dictionaries
+    """
+    flush_audit_log(timeout=2)
+    conn = get_connection()
+    query = """
+        SELECT timestamp, user_id, role, action, details
+        FROM logs
+        WHERE target_type = ? AND target_id = ?
+        ORDER BY ts_ms DESC, log_id DESC
+    """
+    params = [TARGET_PATIENT, patient_id]
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+
+    columns = ['timestamp', 'user_id', 'role', 'action', 'details']
+    events = [dict(zip(columns, row)) for row in conn.execute(query, params)]
+
+    # Archived events are all older than the live ones
+    if limit is None or len(events) < limit:
+        archived = list(_iter_archived_target((TARGET_PATIENT, patient_id)))
+        archived.reverse()
+        events += archived[:None if limit is None else limit - len(events)]
+
+    usernames = dict(conn.execute("SELECT user_id, username FROM users"))
+    return [
+        {
+            'timestamp': event['timestamp'],
+            'user_id': event['user_id'],
+            'username': usernames.get(event['user_id']),
+            'role': event['role'],
+            'action': event['action'],
+            'details': event['details']
+        }
+        for event in events
+    ]
+
+
+def _iter_archived_target(target):
+    """Archived events for one target, oldest first"""
+    for path, _, _ in reversed(find_segments(target=target)):
+        for record in iter_segment(path):
+            if (record['target_type'], record['target_id']) == target:
+                yield record
+
+
+def get_audit_writer():
+    """Get the process-wide audit writer, starting it on first use"""
+    if not _writer.running:
+        _writer.start()
+    return _writer
+
+
+def flush_audit_log(timeout=None):
+    """Block until all queued audit events are in the database"""
+    return _writer.flush(timeout)
+
+
+def shutdown():
+    """Flush the audit writer, then close the pooled connections"""
+    _writer.stop()
+    close_connection()
+    close_all_connections()
+
+
+atexit.register(shutdown)
@@ -1,5 +1,6 @@
-import sqlite3
 import hashlib
+from database import get_connection
+from audit import get_audit_writer, TARGET_USER
 
 def hash_password(password):
     """Hash password using SHA-256"""
@@ -10,52 +11,46 @@ def verify_login(username, password):
     Verify user credentials
     Returns: dict with user info if successful, None if failed
     """
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     
-    try:
-        cursor.execute("""
-            SELECT user_id, username, password, role 
-            FROM users 
-            WHERE username = ?
-        """, (username,))
-        user = cursor.fetchone()
-        
-        # Check if user exists
-        if user is None:
-            log_activity(0, 'unknown', 'login attempt failed', f'username: {username} not found')
-            return None
-        
-        # Verify password
-        input_password = hash_password(password)
-        if user[2] == input_password:
-            log_activity(user[0], user[3], 'login successful', f'username: {username}')
-            return {
-                'user_id': user[0],
-                'username': user[1],
-                'role': user[3]
-            }
-        else:
-            log_activity(user[0], user[3], 'login attempt failed', f'wrong password for {username}')
-            return None
-            
-    finally:
-        conn.close()
+    cursor.execute("""
+        SELECT user_id, username, password, role 
+        FROM users 
+        WHERE username = ?
+    """, (username,))
+    user = cursor.fetchone()
+    
+    # Check if user exists
+    if user is None:
+        log_activity(0, 'unknown', 'login attempt failed', f'username: {username} not found')
+        return None
+    
+    # Verify password
+    input_password = hash_password(password)
+    if user[2] == input_password:
+        log_activity(user[0], user[3], 'login successful', f'username: {username}',
+                     target_type=TARGET_USER, target_id=user[0])
+        return {
+            'user_id': user[0],
+            'username': user[1],
+            'role': user[3]
+        }
+    else:
+        log_activity(user[0], user[3], 'login attempt failed', f'wrong password for {username}',
+                     target_type=TARGET_USER, target_id=user[0])
+        return None
 
 
-def log_activity(user_id, role, action, details=""):
-    """Log user activities to the logs table"""
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("""
-            INSERT INTO logs (user_id, role, action, details)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, role, action, details))
-        conn.commit()
-    finally:
-        conn.close()
+def log_activity(user_id, role, action, details="", durable=False,
+                 target_type=None, target_id=None):
+    """
+    Log user activities to the logs table
+    Events are written in batches by the background audit writer;
+    pass durable=True for events that must be on disk before returning.
+    target_type/target_id name the record acted on (e.g. 'patient', 12).
+    """
+    get_audit_writer().submit(user_id, role, action, details, durable=durable,
+                              target_type=target_type, target_id=target_id)
 
 
 if __name__ == "__main__":
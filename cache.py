@@ -0,0 +1,103 @@
+import functools
+import sys
+import threading
+from collections import OrderedDict
+from database import get_data_version
+
+# Upper bound on memory held by cached query results (approximate)
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+SIZE_SAMPLE_ROWS = 100
+
+
+def estimate_size(value):
+    """Rough memory footprint of a query result in bytes"""
+    if hasattr(value, 'memory_usage'):        # pandas DataFrame
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        if not value:
+            return sys.getsizeof(value)
+        # Extrapolate from a sample instead of walking every row
+        sample = value[:SIZE_SAMPLE_ROWS]
+        per_row = sum(estimate_size(v) for v in sample) / len(sample)
+        return sys.getsizeof(value) + int(per_row * len(value))
+    return sys.getsizeof(value)
+
+
+class QueryCache:
+    """
+    Process-wide LRU cache of query results
+    Every entry remembers the database data_version it was computed at;
+    a lookup only hits while nothing has been committed since, so
+    unchanged data is served from memory to every session.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()     # key -> (data_version, value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key, compute):
+        version = get_data_version()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = compute()
+        size = estimate_size(value)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            if size <= self.max_bytes:
+                self._entries[key] = (version, value, size)
+                self._bytes += size
+                # Evict least recently used entries until we fit
+                while self._bytes > self.max_bytes:
+                    _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                    self._bytes -= evicted_size
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+_cache = QueryCache()
+
+
+def get_query_cache():
+    """Get the process-wide query cache"""
+    return _cache
+
+
+def cached_query(func):
+    """
+    Cache a read-only query function's result per arguments (e.g. role)
+    Callers share the returned object - treat it as read-only.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (func.__module__, func.__qualname__, args, tuple(sorted(kwargs.items())))
+        return _cache.get_or_compute(key, lambda: func(*args, **kwargs))
+    return wrapper
@@ -1,49 +1,224 @@
 import sqlite3
 import hashlib
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
 
-def create_tables():
-    """Create all database tables"""
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
-    # Users table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL UNIQUE,
-            password TEXT NOT NULL,
-            role TEXT NOT NULL
-        )
-    """)
-    
-    # Patients table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS patients (
-            patient_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            contact TEXT NOT NULL,
-            diagnosis TEXT,
-            anonymized_name TEXT,
-            anonymized_contact TEXT,
-            date_added DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
+DB_PATH = 'hospital.db'
+
+# Connection tuning applied once when a pooled connection is opened
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KB = 64 * 1024          # page cache per connection (64 MB)
+MMAP_SIZE = 256 * 1024 * 1024      # memory-mapped I/O window (256 MB)
+STATEMENT_CACHE_SIZE = 256         # prepared statements kept per connection
+MAX_IDLE_CONNECTIONS = 8
+STREAM_CHUNK_SIZE = 1000           # rows per fetchmany() when streaming
+
+_pool = []
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+# Application SQL functions installed on every connection, name -> (num_params, func)
+_sql_functions = {}
+_sql_functions_version = 0
+
+
+def _open_connection():
+    """Open and configure a new SQLite connection"""
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,                 # transactions are managed by transaction()
+        check_same_thread=False,              # pooled connections move between threads
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+def _release_connection(conn):
+    """Return a connection to the idle pool (or close it if the pool is full)"""
+    if conn.in_transaction:
+        conn.rollback()
+    with _pool_lock:
+        if len(_pool) < MAX_IDLE_CONNECTIONS:
+            _pool.append(conn)
+            return
+    conn.close()
+
+
+class _Lease:
+    """Binds a pooled connection to the current thread until the thread exits"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.depth = 0
+        self.functions_version = -1
+
+    def __del__(self):
+        try:
+            _release_connection(self.conn)
+        except Exception:
+            pass
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def get_data_version():
+    """
+    Change counter for the whole database
+    Read from a dedicated connection that never writes, so PRAGMA
+    data_version moves on every commit made by any other connection -
+    pooled connections in this process and other processes alike.
+    """
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = _open_connection()
+        return _watcher.execute("PRAGMA data_version").fetchone()[0]
+
+
+def get_connection():
+    """
+    Get the calling thread's pooled connection
+    The same connection is returned for every call made from one thread,
+    so nested helpers see each other's uncommitted work.
+    Do not close it - use close_connection() instead.
+    """
+    lease = getattr(_local, 'lease', None)
+    if lease is None:
+        with _pool_lock:
+            conn = _pool.pop() if _pool else None
+        lease = _Lease(conn or _open_connection())
+        _local.lease = lease
+    if lease.functions_version != _sql_functions_version:
+        _install_sql_functions(lease)
+    return lease.conn
+
+
+def register_sql_function(name, num_params, func):
+    """
+    Register a deterministic Python function callable from SQL
+    It is installed on every pooled connection, so set-based UPDATEs and
+    views can call e.g. mask_contact(contact) without a Python loop.
+    """
+    global _sql_functions_version
+    with _pool_lock:
+        _sql_functions[name] = (num_params, func)
+        _sql_functions_version += 1
+
+
+def _install_sql_functions(lease):
+    with _pool_lock:
+        functions = dict(_sql_functions)
+        version = _sql_functions_version
+    for name, (num_params, func) in functions.items():
+        lease.conn.create_function(name, num_params, func, deterministic=True)
+    lease.functions_version = version
+
+
+@contextmanager
+def transaction():
+    """
+    Run a block inside a write transaction on the thread's connection
+    Nested blocks join the outer transaction through SAVEPOINTs, so
+    add_patient -> log_activity commits (or rolls back) as one unit.
+    """
+    conn = get_connection()
+    lease = _local.lease
     
-    # Logs table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS logs (
-            log_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            role TEXT NOT NULL,
-            action TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            details TEXT,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-    """)
+    if lease.depth == 0:
+        conn.execute("BEGIN IMMEDIATE")
+    else:
+        conn.execute(f"SAVEPOINT sp_{lease.depth}")
+    lease.depth += 1
     
-    conn.commit()
-    conn.close()
+    try:
+        yield conn
+    except BaseException:
+        lease.depth -= 1
+        if lease.depth == 0:
+            conn.execute("ROLLBACK")
+        else:
+            conn.execute(f"ROLLBACK TO sp_{lease.depth}")
+            conn.execute(f"RELEASE sp_{lease.depth}")
+        raise
+    else:
+        lease.depth -= 1
+        if lease.depth == 0:
+            conn.execute("COMMIT")
+        else:
+            conn.execute(f"RELEASE sp_{lease.depth}")
+
+
+def close_connection():
+    """Release the calling thread's connection back to the pool"""
+    lease = getattr(_local, 'lease', None)
+    if lease is not None and lease.depth == 0:
+        del _local.lease
+
+
+def close_all_connections():
+    """Close every idle pooled connection (e.g. before replacing the database file)"""
+    with _pool_lock:
+        idle = list(_pool)
+        _pool.clear()
+    for conn in idle:
+        conn.close()
+
+
+_row_types = {}
+
+
+def row_type(name, columns):
+    """
+    Get a namedtuple class for a result shape (cached per column list)
+    Rows stay plain tuples in memory - no per-row dict.
+    """
+    key = (name, tuple(columns))
+    if key not in _row_types:
+        _row_types[key] = namedtuple(name, columns)
+    return _row_types[key]
+
+
+def iter_rows(query, params=(), chunk_size=STREAM_CHUNK_SIZE, chunked=False, row_name='Row'):
+    """
+    Stream a query's results straight from the cursor with fetchmany()
+    Yields one namedtuple per row, or lists of up to chunk_size rows
+    when chunked=True, so memory stays constant however big the table is.
+    Runs on a dedicated cursor of the thread's connection.
+    """
+    cursor = get_connection().cursor()
+    try:
+        cursor.execute(query, params)
+        make_row = row_type(row_name, [d[0] for d in cursor.description])._make
+        
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            if chunked:
+                yield [make_row(row) for row in rows]
+            else:
+                yield from map(make_row, rows)
+    finally:
+        cursor.close()
+
+
+def create_tables():
+    """
+    Create all database tables
+    The schema lives in migrations.py; this applies any pending migrations.
+    """
+    from migrations import run_migrations
+    run_migrations()
 
 
 def hash_password(password):
@@ -53,19 +228,14 @@ def hash_password(password):
 
 def seed_users():
     """Add default users to database"""
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
     users = [
         ('admin', hash_password('admin123'), 'admin'),
         ('dr_bob', hash_password('doc123'), 'doctor'),
         ('alice', hash_password('rec123'), 'receptionist')
     ]
     
-    cursor.executemany("""
-        INSERT OR IGNORE INTO users (username, password, role) 
-        VALUES (?, ?, ?)
-    """, users)
-    
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.executemany("""
+            INSERT OR IGNORE INTO users (username, password, role) 
+            VALUES (?, ?, ?)
+        """, users)
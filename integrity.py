@@ -0,0 +1,240 @@
+import hashlib
+import hmac
+import heapq
+import json
+import os
+import time
+from datetime import datetime, timezone
+from database import get_connection, transaction
+from keystore import get_audit_key
+from archive import iter_segment
+
+# Chain state before the first chained event
+GENESIS_HASH = '0' * 64
+
+# The audit writer signs a checkpoint at every event whose log_id is a
+# multiple of this, so a missing checkpoint can be told from a gap
+AUDIT_CHECKPOINT_INTERVAL = 1000
+
+# Append-only record of every verified chain position, kept outside
+# hospital.db so rewriting the database can't rewind what was verified
+AUDIT_ANCHOR_FILE = 'audit_anchors.log'
+
+
+def chain_hash(prev_hash, log_id, user_id, role, action, ts_ms, details, target_type, target_id):
+    """
+    Keyed hash of one audit event, chained to the previous event's hash
+    HMAC with audit.key, so the chain can't be recomputed after an edit.
+    Covers the readable role/action names, so archived copies hash the same.
+    """
+    payload = json.dumps(
+        [log_id, user_id, role, action, ts_ms, details, target_type, target_id],
+        separators=(',', ':'), ensure_ascii=False
+    )
+    return hmac.new(get_audit_key(), (prev_hash + payload).encode(), hashlib.sha256).hexdigest()
+
+
+def sign_checkpoint(log_id, entry_hash):
+    """HMAC over a chain position - can't be forged without audit.key"""
+    message = f"{log_id}:{entry_hash}".encode()
+    return hmac.new(get_audit_key(), message, hashlib.sha256).hexdigest()
+
+
+def _checkpoint_valid(log_id, entry_hash, signature):
+    return hmac.compare_digest(sign_checkpoint(log_id, entry_hash), signature)
+
+
+def save_checkpoint(conn, log_id, entry_hash, verified=False):
+    """Record a signed checkpoint (inside the caller's transaction)"""
+    conn.execute("""
+        INSERT INTO audit_checkpoints (log_id, entry_hash, signature, verified_at)
+        VALUES (?, ?, ?, ?)
+    """, (log_id, entry_hash, sign_checkpoint(log_id, entry_hash),
+          datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S') if verified else None))
+
+
+def chain_events(conn, rows):
+    """
+    Assign log ids and chain hashes to new audit rows
+    Must run inside the write transaction that inserts them, so the
+    chain head can't move underneath us.
+
+    Returns: List of (log_id, *row, entry_hash)
+    """
+    last_id, last_hash = conn.execute(
+        "SELECT last_log_id, last_hash FROM audit_chain_head"
+    ).fetchone()
+
+    chained = []
+    for row in rows:
+        last_id += 1
+        last_hash = chain_hash(last_hash, last_id, *row)
+        chained.append((last_id,) + tuple(row) + (last_hash,))
+        if last_id % AUDIT_CHECKPOINT_INTERVAL == 0:
+            save_checkpoint(conn, last_id, last_hash)
+
+    conn.execute("UPDATE audit_chain_head SET last_log_id = ?, last_hash = ?", (last_id, last_hash))
+
+    return chained
+
+
+def read_anchors(path=AUDIT_ANCHOR_FILE):
+    """
+    Verified chain positions from the anchor file
+    Returns: List of (log_id, entry_hash, signature), oldest first
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            lines = [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+    anchors = []
+    for line in lines:
+        log_id, entry_hash, signature = line.split(':')
+        anchors.append((int(log_id), entry_hash, signature))
+    return anchors
+
+
+def append_anchor(log_id, entry_hash, path=AUDIT_ANCHOR_FILE):
+    """Append a signed chain position to the anchor file and sync it"""
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(f"{log_id}:{entry_hash}:{sign_checkpoint(log_id, entry_hash)}\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _live_chain(after_log_id, up_to_log_id):
+    """Live events in a chain range, in log_id order"""
+    return get_connection().execute("""
+        SELECT e.log_id, e.user_id, r.name, a.name, e.ts_ms, e.details,
+               e.target_type, e.target_id, e.entry_hash
+        FROM log_events e
+        JOIN log_roles r ON r.role_id = e.role_id
+        JOIN log_actions a ON a.action_id = e.action_id
+        WHERE e.log_id > ? AND e.log_id <= ?
+        ORDER BY e.log_id
+    """, (after_log_id, up_to_log_id))
+
+
+def _archived_chain(after_log_id):
+    """
+    Archived events after a chain position, merged into log_id order
+    Archived rows were deleted from log_events, so the two never overlap;
+    segments written before the chain existed carry no entry_hash.
+    """
+    conn = get_connection()
+    paths = [row[0] for row in conn.execute("SELECT path FROM log_archive_segments ORDER BY segment_id")]
+
+    def records(path):
+        for record in iter_segment(path):
+            if record['log_id'] > after_log_id and 'entry_hash' in record:
+                yield (record['log_id'], record['user_id'], record['role'], record['action'],
+                       record['ts_ms'], record['details'], record['target_type'],
+                       record['target_id'], record['entry_hash'])
+
+    return heapq.merge(*(records(path) for path in paths))
+
+
+def verify_audit_log(full=False):
+    """
+    Check the audit log hash chain
+    Starts from the newest verified checkpoint, so a routine check only
+    rehashes events written since the last one; full=True rehashes from
+    the start of the chain, including archived segments. Every signed
+    checkpoint and every position in the anchor file must still match,
+    and no checkpoint may be missing. On success the current head is
+    saved as a verified checkpoint and appended to the anchor file.
+
+    Returns: Dictionary with ok, checked (events rehashed), from_log_id,
+    to_log_id, error (None if ok) and seconds
+    """
+    started = time.perf_counter()
+    conn = get_connection()
+
+    # Anchors first: any anchor written later can't predate our snapshot
+    anchors = read_anchors()
+
+    # Checkpoints and head from one read snapshot, so a checkpoint the
+    # writer adds in between can't look missing. Events only append, so
+    # everything up to this head stays visible after the snapshot ends.
+    conn.execute("BEGIN")
+    try:
+        checkpoints = conn.execute("""
+            SELECT checkpoint_id, log_id, entry_hash, signature, verified_at
+            FROM audit_checkpoints
+            ORDER BY log_id
+        """).fetchall()
+        head = conn.execute("SELECT last_log_id, last_hash FROM audit_chain_head").fetchone()
+    finally:
+        conn.execute("COMMIT")
+
+    result = {'ok': False, 'checked': 0, 'from_log_id': None, 'to_log_id': None, 'error': None}
+
+    def fail(message):
+        result['error'] = message
+        result['seconds'] = time.perf_counter() - started
+        return result
+
+    for checkpoint_id, log_id, entry_hash, signature, _ in checkpoints:
+        if not _checkpoint_valid(log_id, entry_hash, signature):
+            return fail(f"Checkpoint {checkpoint_id} at event {log_id} has an invalid signature")
+    for log_id, entry_hash, signature in anchors:
+        if not _checkpoint_valid(log_id, entry_hash, signature):
+            return fail(f"Anchor at event {log_id} has an invalid signature")
+
+    verified = [cp for cp in checkpoints if cp[4] is not None]
+    if not verified:
+        return fail("No verified checkpoint to start from")
+    start = verified[0] if full else verified[-1]
+    prev_id, prev_hash = start[1], start[2]
+    result['from_log_id'] = prev_id
+
+    # Positions the chain must pass through: signed checkpoints in the
+    # database, and verified positions recorded outside it
+    expected = {}
+    for log_id, entry_hash in [cp[1:3] for cp in checkpoints] + [anchor[:2] for anchor in anchors]:
+        if expected.setdefault(log_id, entry_hash) != entry_hash:
+            return fail(f"Checkpoints for event {log_id} disagree")
+    if expected.get(prev_id, prev_hash) != prev_hash:
+        return fail(f"Event {prev_id} doesn't match its signed checkpoint")
+    expected = {log_id: entry_hash for log_id, entry_hash in expected.items() if log_id > prev_id}
+    checkpointed = {cp[1] for cp in checkpoints}
+
+    rows = _live_chain(prev_id, head[0])
+    if full:
+        rows = heapq.merge(_archived_chain(prev_id), rows)
+
+    for log_id, user_id, role, action, ts_ms, details, target_type, target_id, entry_hash in rows:
+        computed = chain_hash(prev_hash, log_id, user_id, role, action, ts_ms, details, target_type, target_id)
+        if computed != entry_hash:
+            return fail(f"Event {log_id} was modified, or an event before it was deleted")
+        if log_id in expected and expected.pop(log_id) != entry_hash:
+            return fail(f"Event {log_id} doesn't match its signed checkpoint")
+        if log_id % AUDIT_CHECKPOINT_INTERVAL == 0 and log_id not in checkpointed:
+            return fail(f"The checkpoint at event {log_id} is missing")
+        prev_id, prev_hash = log_id, entry_hash
+        result['checked'] += 1
+
+    # Signed positions past the end of the chain mean events were cut off
+    if expected:
+        return fail(f"Events after {prev_id} are missing (checkpoint at {max(expected)})")
+    if head != (prev_id, prev_hash):
+        return fail(f"Chain ends at event {prev_id} but the head says {head[0]}")
+
+    with transaction() as conn:
+        conn.execute("""
+            UPDATE audit_checkpoints
+            SET verified_at = COALESCE(verified_at, ?)
+            WHERE log_id <= ?
+        """, (datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'), prev_id))
+        exists = conn.execute(
+            "SELECT 1 FROM audit_checkpoints WHERE log_id = ?", (prev_id,)
+        ).fetchone()
+        if not exists:
+            save_checkpoint(conn, prev_id, prev_hash, verified=True)
+
+    if not anchors or anchors[-1][0] < prev_id:
+        append_anchor(prev_id, prev_hash)
+
+    result.update(ok=True, to_log_id=prev_id, seconds=time.perf_counter() - started)
+    return result
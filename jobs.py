@@ -0,0 +1,799 @@
+# jobs.py - Long-running bulk jobs over the patients table
+#
+# Usage: python jobs.py encrypt [--workers N] [--chunk-size N] [--restart]
+#        python jobs.py rotate [--resume] [--chunk-size N] [--keep-old-keys]
+#        python jobs.py index
+#        python jobs.py import FILE [--encrypt] [--workers N] [--batch-size N]
+
+import argparse
+import csv
+import gzip
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from cryptography.fernet import Fernet, InvalidToken
+from database import get_connection, transaction
+from keystore import get_key_manager, get_index_key, PLAINTEXT, ENVELOPE
+from migrations import run_migrations
+from auth import log_activity
+from audit import export_audit_logs
+from archive import archive_audit_logs, LOG_ARCHIVE_AGE_DAYS
+from integrity import verify_audit_log
+from privacy import (
+    anonymize_name,
+    mask_contact,
+    normalize_contact,
+    name_index,
+    contact_index,
+    match_retention_policy,
+    NEXT_PATIENT_ID_SQL,
+    build_blind_indexes,
+    sweep_expired_data,
+    retention_lag_days,
+    ENVELOPE_ENCRYPTION
+)
+
+ENCRYPT_JOB = 'encrypt_patients'
+ENCRYPT_CHUNK_SIZE = 2000
+
+ROTATE_JOB = 'rotate_keys'
+ROTATE_CHUNK_SIZE = 500
+ROTATE_PAUSE = 0.05     # seconds between batches so interactive writers get the lock
+
+IMPORT_BATCH_SIZE = 5000
+IMPORT_MAX_ERRORS = 20  # rejected records reported individually
+
+
+# ---------- checkpoints ----------
+
+def get_checkpoint(job_name):
+    """Last patient_id a job fully processed (0 if it never ran)"""
+    row = get_connection().execute(
+        "SELECT last_id FROM job_checkpoints WHERE job_name = ?", (job_name,)
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def save_checkpoint(conn, job_name, last_id):
+    """Record progress inside the caller's transaction"""
+    conn.execute("""
+        INSERT INTO job_checkpoints (job_name, last_id, updated_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(job_name) DO UPDATE
+        SET last_id = excluded.last_id, updated_at = excluded.updated_at
+    """, (job_name, last_id))
+
+
+def reset_checkpoint(job_name):
+    """Forget a job's progress so the next run starts from the beginning"""
+    with transaction() as conn:
+        conn.execute("DELETE FROM job_checkpoints WHERE job_name = ?", (job_name,))
+
+
+# ---------- bulk encryption ----------
+
+_worker_fernet = None
+_worker_envelope = False
+
+
+def _init_worker(key, envelope):
+    global _worker_fernet, _worker_envelope
+    _worker_fernet = Fernet(key)
+    _worker_envelope = envelope
+
+
+def _encrypt_rows(rows):
+    """
+    Worker: encrypt name/contact/diagnosis for a chunk of plaintext rows
+    In envelope mode every row gets its own data key, wrapped by the
+    master key. Returns (wrapped_key, fields..., indexes..., patient_id,
+    originals...) tuples for _write_chunk.
+    """
+    master = _worker_fernet
+    results = []
+    for patient_id, name, contact, diagnosis in rows:
+        originals = (name, contact, diagnosis)
+        if _worker_envelope:
+            data_key = Fernet.generate_key()
+            fernet = Fernet(data_key)
+            wrapped_key = master.encrypt(data_key).decode()
+        else:
+            fernet = master
+            wrapped_key = None
+        encrypted = tuple(fernet.encrypt(v.encode()).decode() if v else v for v in originals)
+        indexes = (name_index(name), contact_index(contact))
+        results.append((wrapped_key,) + encrypted + (mask_contact(contact),) + indexes
+                       + (patient_id,) + originals)
+    return results
+
+
+def _read_chunk(after_id, limit):
+    """Next plaintext rows after after_id (keyset scan of idx_patients_key_version)"""
+    return get_connection().execute("""
+        SELECT patient_id, name, contact, diagnosis
+        FROM patients
+        WHERE key_version = ? AND patient_id > ?
+        ORDER BY patient_id
+        LIMIT ?
+    """, (PLAINTEXT, after_id, limit)).fetchall()
+
+
+def _insert_data_keys(conn, results, kek_version):
+    """
+    Store the wrapped data keys of a chunk under ids allocated inside
+    the caller's transaction
+    Returns: key_id of the first result (the rest follow consecutively)
+    """
+    first_key_id = conn.execute(
+        "SELECT COALESCE(MAX(key_id), 0) + 1 FROM data_keys"
+    ).fetchone()[0]
+    conn.executemany("""
+        INSERT INTO data_keys (key_id, wrapped_key, kek_version)
+        VALUES (?, ?, ?)
+    """, [(first_key_id + i, r[0], kek_version) for i, r in enumerate(results)])
+    return first_key_id
+
+
+def _to_current_master(results, kek_version, envelope):
+    """
+    Bring a prepared chunk up to the current master key version
+    Runs inside the write transaction: a rotation may have finished since
+    the workers encrypted the chunk with kek_version, so the wrapped data
+    keys (envelope) or the fields themselves are rotated if it moved on.
+    Raises RuntimeError if kek_version has already been retired.
+
+    Returns: (results, current master key version)
+    """
+    manager = get_key_manager()
+    fernet, current = manager.current()
+    if current == kek_version:
+        return results, current
+    if kek_version not in manager.versions:
+        raise RuntimeError(f"Master key version {kek_version} was retired while the job ran - run it again")
+
+    def rotate(value):
+        return fernet.rotate(value.encode()).decode() if value else value
+
+    if envelope:
+        return [(rotate(r[0]),) + r[1:] for r in results], current
+    return [(r[0],) + tuple(rotate(v) for v in r[1:4]) + r[4:] for r in results], current
+
+
+def _write_chunk(results, last_id, key_version, kek_version):
+    """Single writer: apply one chunk and advance the checkpoint atomically"""
+    with transaction() as conn:
+        envelope = key_version == ENVELOPE
+        results, kek_version = _to_current_master(results, kek_version, envelope)
+        if not envelope:
+            key_version = kek_version
+        if envelope:
+            first_key_id = _insert_data_keys(conn, results, kek_version)
+
+        updates = [r[1:5] + (key_version, first_key_id + i if envelope else None) + r[5:]
+                   for i, r in enumerate(results)]
+
+        # Only rows still plaintext and unchanged since they were read
+        cursor = conn.executemany("""
+            UPDATE patients
+            SET name = ?, contact = ?, diagnosis = ?,
+                anonymized_contact = ?, key_version = ?, data_key_id = ?,
+                name_index = ?, contact_index = ?
+            WHERE patient_id = ? AND key_version = 0
+              AND name IS ? AND contact IS ? AND diagnosis IS ?
+        """, updates)
+        count = cursor.rowcount
+
+        if envelope and count < len(results):
+            # Drop the keys of rows that were skipped
+            conn.execute("""
+                DELETE FROM data_keys
+                WHERE key_id BETWEEN ? AND ?
+                  AND key_id NOT IN (SELECT data_key_id FROM patients
+                                     WHERE data_key_id BETWEEN ? AND ?)
+            """, (first_key_id, first_key_id + len(results) - 1) * 2)
+
+        save_checkpoint(conn, ENCRYPT_JOB, last_id)
+        return count
+
+
+def encrypt_all_patients(workers=None, chunk_size=ENCRYPT_CHUNK_SIZE,
+                         restart=False, progress=None, envelope=None):
+    """
+    Encrypt every plaintext patient's name, contact and diagnosis
+    Plaintext rows are found through the key_version index and encrypted
+    in a process pool; results are written back in order by this process,
+    one transaction per chunk together with the checkpoint. An interrupted
+    run resumes after the last committed chunk, and rows that are already
+    encrypted are never selected.
+    progress(done, total, encrypted, rows_per_sec) is called per chunk.
+    envelope=True gives every row its own data key (default: privacy.ENVELOPE_ENCRYPTION)
+
+    Returns: Number of patients encrypted
+    """
+    if restart:
+        reset_checkpoint(ENCRYPT_JOB)
+    after_id = get_checkpoint(ENCRYPT_JOB)
+
+    total = get_connection().execute(
+        "SELECT COUNT(*) FROM patients WHERE key_version = ? AND patient_id > ?",
+        (PLAINTEXT, after_id)
+    ).fetchone()[0]
+    if total == 0:
+        reset_checkpoint(ENCRYPT_JOB)
+        print("ℹ️ No patients left to encrypt")
+        return 0
+
+    if envelope is None:
+        envelope = ENVELOPE_ENCRYPTION
+    manager = get_key_manager()
+    key, kek_version = manager.key, manager.current_version
+    get_index_key()     # create it before the workers need it
+    key_version = ENVELOPE if envelope else kek_version
+    workers = workers or os.cpu_count() or 1
+    started = time.monotonic()
+    done = 0
+    count = 0
+
+    def next_chunk():
+        nonlocal after_id
+        rows = _read_chunk(after_id, chunk_size)
+        if rows:
+            after_id = rows[-1][0]
+        return rows
+
+    def write(results, rows_read, last_id):
+        nonlocal done, count
+        count += _write_chunk(results, last_id, key_version, kek_version)
+        done += rows_read
+        if progress:
+            elapsed = time.monotonic() - started
+            progress(min(done, total), total, count, count / elapsed if elapsed else 0.0)
+
+    if workers == 1 or total <= chunk_size:
+        _init_worker(key, envelope)
+        while rows := next_chunk():
+            write(_encrypt_rows(rows), len(rows), after_id)
+    else:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_worker, initargs=(key, envelope)) as pool:
+            # Keep a bounded number of chunks in flight, write them in order
+            in_flight = []
+            while len(in_flight) < workers * 2 and (rows := next_chunk()):
+                in_flight.append((len(rows), after_id, pool.submit(_encrypt_rows, rows)))
+
+            while in_flight:
+                rows_read, last_id, future = in_flight.pop(0)
+                write(future.result(), rows_read, last_id)
+
+                if rows := next_chunk():
+                    in_flight.append((len(rows), after_id, pool.submit(_encrypt_rows, rows)))
+
+    # Finished: the next run only needs to look for new plaintext rows
+    reset_checkpoint(ENCRYPT_JOB)
+    print(f"✅ Encrypted {count} patients")
+    return count
+
+
+# ---------- key rotation ----------
+
+def _rotate_version(version, current, chunk_size, pause, report):
+    """Move every row encrypted with one old key version to the current key"""
+    manager = get_key_manager()
+    job_name = f'{ROTATE_JOB}:v{version}'
+    after_id = get_checkpoint(job_name)
+
+    while True:
+        rows = get_connection().execute("""
+            SELECT patient_id, name, contact, diagnosis
+            FROM patients
+            WHERE key_version = ? AND patient_id > ?
+            ORDER BY patient_id
+            LIMIT ?
+        """, (version, after_id, chunk_size)).fetchall()
+        if not rows:
+            break
+        after_id = rows[-1][0]
+
+        # Decrypt with any key in the ring, re-encrypt with the current one
+        results = []
+        for row in rows:
+            try:
+                results.append(tuple(manager.rotate_many(row[1:])) + (current, row[0], version))
+            except InvalidToken:
+                # Key no longer in the ring - leave the row for manual review
+                print(f"⚠️ Patient {row[0]} can't be decrypted with any known key")
+
+        with transaction() as conn:
+            cursor = conn.executemany("""
+                UPDATE patients
+                SET name = ?, contact = ?, diagnosis = ?, key_version = ?
+                WHERE patient_id = ? AND key_version = ?
+            """, results)
+            save_checkpoint(conn, job_name, after_id)
+        report(len(rows), cursor.rowcount)
+
+        # Short batches + a pause keep the write lock free for the UI
+        time.sleep(pause)
+
+    reset_checkpoint(job_name)
+
+
+def _rewrap_version(version, current, chunk_size, pause, report):
+    """Re-wrap every data key wrapped by one old master key version"""
+    manager = get_key_manager()
+    job_name = f'{ROTATE_JOB}:keys:v{version}'
+    after_id = get_checkpoint(job_name)
+
+    while True:
+        keys = get_connection().execute("""
+            SELECT key_id, wrapped_key
+            FROM data_keys
+            WHERE kek_version = ? AND key_id > ?
+            ORDER BY key_id
+            LIMIT ?
+        """, (version, after_id, chunk_size)).fetchall()
+        if not keys:
+            break
+        after_id = keys[-1][0]
+
+        # Only the small wrapped key changes - patient ciphertext is untouched
+        results = [(wrapped, current, key_id, version)
+                   for (key_id, _), wrapped in zip(keys, manager.rotate_many([k[1] for k in keys]))]
+
+        with transaction() as conn:
+            cursor = conn.executemany("""
+                UPDATE data_keys
+                SET wrapped_key = ?, kek_version = ?
+                WHERE key_id = ? AND kek_version = ?
+            """, results)
+            save_checkpoint(conn, job_name, after_id)
+        report(len(keys), cursor.rowcount)
+
+        time.sleep(pause)
+
+    reset_checkpoint(job_name)
+
+
+def count_stale_ciphertext(current):
+    """Rows and data keys still encrypted with a master key older than current"""
+    conn = get_connection()
+    rows = conn.execute(
+        "SELECT COUNT(*) FROM patients WHERE key_version > ? AND key_version < ?",
+        (PLAINTEXT, current)
+    ).fetchone()[0]
+    keys = conn.execute(
+        "SELECT COUNT(*) FROM data_keys WHERE kek_version < ?", (current,)
+    ).fetchone()[0]
+    return rows + keys
+
+
+def rotate_encryption_key(chunk_size=ROTATE_CHUNK_SIZE, pause=ROTATE_PAUSE,
+                          retire_old_keys=True, progress=None):
+    """
+    Move everything still on an old master key version to the current one
+    Call KeyManager.add_key() first to start a rotation. Envelope data
+    keys are re-wrapped (one small row per key, patient data untouched);
+    rows encrypted directly with the master key are re-encrypted. Both run
+    in small transactions (MultiFernet.rotate), so readers - which can
+    decrypt with every key in the ring - are never blocked. Progress is
+    checkpointed per key version, so an interrupted rotation resumes.
+    progress(done, total, rotated, rows_per_sec) is called per batch.
+
+    Returns: Number of rows and data keys rotated
+    """
+    manager = get_key_manager()
+    current = manager.current_version
+    started = time.monotonic()
+    done = 0
+    count = 0
+
+    total = count_stale_ciphertext(current)
+
+    def report(rows_read, rows_rotated):
+        nonlocal done, count
+        done += rows_read
+        count += rows_rotated
+        if progress:
+            elapsed = time.monotonic() - started
+            progress(min(done, total), total, count, count / elapsed if elapsed else 0.0)
+
+    old_versions = [v for v in manager.versions if v != current]
+    for version in old_versions:
+        _rewrap_version(version, current, chunk_size, pause, report)
+        _rotate_version(version, current, chunk_size, pause, report)
+
+    if retire_old_keys and old_versions:
+        # Count and retire under the write lock: writers re-read the keyring
+        # inside their own write transaction, so none can commit ciphertext
+        # on an old version between the check and the retire
+        with transaction():
+            remaining = count_stale_ciphertext(current)
+            if remaining == 0:
+                manager.retire_keys(old_versions)
+        if remaining == 0:
+            print(f"🗑️ Retired key versions {old_versions}")
+        else:
+            print(f"⚠️ {remaining} records still use old key versions - run the rotation again")
+
+    print(f"✅ Rotated {count} records to key version {current}")
+    return count
+
+
+# Status of the background rotation, read by the admin dashboard
+rotation_status = {
+    'running': False,
+    'key_version': None,
+    'done': 0,
+    'total': 0,
+    'rotated': 0,
+    'rows_per_sec': 0.0,
+    'error': None
+}
+_rotation_lock = threading.Lock()
+
+
+def start_key_rotation(new_key=True, **kwargs):
+    """
+    Start a key rotation on a background thread
+    new_key=False resumes an interrupted rotation without adding a key.
+
+    Returns: False if a rotation is already running
+    """
+    with _rotation_lock:
+        if rotation_status['running']:
+            return False
+        rotation_status.update(running=True, done=0, total=0, rotated=0,
+                               rows_per_sec=0.0, error=None)
+
+    if new_key:
+        rotation_status['key_version'] = get_key_manager().add_key()
+    else:
+        rotation_status['key_version'] = get_key_manager().current_version
+
+    def update(done, total, rotated, rate):
+        rotation_status.update(done=done, total=total, rotated=rotated, rows_per_sec=rate)
+
+    def run():
+        try:
+            rotate_encryption_key(progress=update, **kwargs)
+        except Exception as e:
+            rotation_status['error'] = str(e)
+            print(f"❌ Key rotation failed: {e}")
+        finally:
+            rotation_status['running'] = False
+
+    threading.Thread(target=run, name="key-rotation", daemon=True).start()
+    return True
+
+
+# ---------- bulk import ----------
+
+def _open_import(path):
+    """Open a CSV/JSONL import file as text (.gz is decompressed on the fly)"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, 'r', encoding='utf-8', newline='')
+
+
+def _import_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'jsonl' if name.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def _iter_import_records(f, fmt):
+    """Raw records with their line numbers: dicts for CSV, unparsed lines for JSONL"""
+    if fmt == 'csv':
+        reader = csv.DictReader(f)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_no, line in enumerate(f, 1):
+            if line.strip():
+                yield line_no, line
+
+
+def _clean_record(record):
+    """
+    Validate one import record
+    Returns: (name, contact, diagnosis, date_added) - raises ValueError if invalid
+    """
+    if isinstance(record, str):
+        record = json.loads(record)     # JSONDecodeError is a ValueError
+    if not isinstance(record, dict):
+        raise ValueError("record is not an object")
+
+    name, contact, diagnosis, date_added = (
+        str(record[key]).strip() if record.get(key) not in (None, '') else None
+        for key in ('name', 'contact', 'diagnosis', 'date_added')
+    )
+    if not name:
+        raise ValueError("name is missing")
+    if not contact:
+        raise ValueError("contact is missing")
+    if normalize_contact(contact) is None:
+        raise ValueError(f"contact {contact!r} has no digits")
+
+    if date_added:
+        # Keep the original admission date (retention is counted from it)
+        try:
+            date_added = datetime.fromisoformat(date_added).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            raise ValueError(f"date_added {date_added!r} is not YYYY-MM-DD [HH:MM:SS]") from None
+
+    return name, contact, diagnosis or None, date_added
+
+
+def _import_batches(f, fmt, batch_size, result):
+    """Valid records in batches of (position, name, contact, diagnosis); rejects go to result"""
+    batch = []
+    for line_no, record in _iter_import_records(f, fmt):
+        try:
+            batch.append(_clean_record(record))
+        except (ValueError, TypeError) as e:
+            result['rejected'] += 1
+            if len(result['errors']) < IMPORT_MAX_ERRORS:
+                result['errors'].append(f"line {line_no}: {e}")
+            continue
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _prepare_import(rows, encrypt):
+    """
+    Worker: mask, index and optionally encrypt a batch of clean records
+    Returns the _encrypt_rows layout: (wrapped_key, name, contact,
+    diagnosis, anonymized_contact, name_index, contact_index, position,
+    plaintext name, contact, diagnosis)
+    """
+    numbered = [(i, name, contact, diagnosis) for i, (name, contact, diagnosis, _) in enumerate(rows)]
+    if encrypt:
+        return _encrypt_rows(numbered)
+    return [(None, name, contact, diagnosis, mask_contact(contact),
+             name_index(name), contact_index(contact), i, name, contact, diagnosis)
+            for i, name, contact, diagnosis in numbered]
+
+
+def _write_import_batch(rows, results, key_version, kek_version, policies):
+    """
+    Insert one prepared batch in a single transaction
+    patient_ids are allocated up front (never reusing ids of deleted
+    patients), so the anonymized name and retention date go into the
+    same row write as the data.
+
+    Returns: (first patient_id, last patient_id)
+    """
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    retention_dates = {}
+
+    with transaction() as conn:
+        first_id = conn.execute(NEXT_PATIENT_ID_SQL).fetchone()[0]
+
+        envelope = key_version == ENVELOPE
+        if key_version != PLAINTEXT:
+            results, kek_version = _to_current_master(results, kek_version, envelope)
+            if not envelope:
+                key_version = kek_version
+        if envelope:
+            first_key_id = _insert_data_keys(conn, results, kek_version)
+
+        inserts = []
+        for i, result in enumerate(results):
+            patient_id = first_id + i
+            date_added = rows[result[7]][3] or now
+            diagnosis = result[10]
+
+            # Policies are matched on the plaintext diagnosis (a few distinct values per import)
+            if diagnosis not in policies:
+                policies[diagnosis] = match_retention_policy(diagnosis, conn)
+            policy = policies[diagnosis]
+            if policy:
+                expiry = (date_added[:10], policy[1])
+                if expiry not in retention_dates:
+                    retention_dates[expiry] = str(date.fromisoformat(expiry[0]) + timedelta(days=expiry[1]))
+                retention_date = retention_dates[expiry]
+            else:
+                retention_date = None
+
+            inserts.append((patient_id,) + result[1:4]
+                           + (anonymize_name(patient_id), result[4], result[5], result[6],
+                              key_version, first_key_id + i if envelope else None,
+                              date_added, policy[0] if policy else None, retention_date))
+
+        conn.executemany("""
+            INSERT INTO patients (patient_id, name, contact, diagnosis,
+                                  anonymized_name, anonymized_contact, name_index, contact_index,
+                                  key_version, data_key_id,
+                                  date_added, retention_policy_id, retention_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, inserts)
+
+    return first_id, first_id + len(inserts) - 1
+
+
+def import_patients(path, user_id=0, role='system', fmt=None, batch_size=IMPORT_BATCH_SIZE,
+                    encrypt=False, workers=None, envelope=None, progress=None):
+    """
+    Bulk-load patients from a CSV or JSONL file (optionally .gz)
+    Records (name, contact, diagnosis, optional date_added) are streamed,
+    validated and anonymized in batches; each batch is inserted with one
+    executemany in one transaction, retention policy included, and
+    summarized by a single audit event. encrypt=True encrypts the fields
+    in a process pool first (envelope=True: per-record data keys, default
+    privacy.ENVELOPE_ENCRYPTION). Invalid records are skipped and reported.
+    progress(imported, rejected, rows_per_sec) is called per batch.
+
+    Returns: Dictionary with imported, rejected, errors (first few
+    messages), first_id, last_id, seconds and rows_per_sec
+    """
+    fmt = fmt or _import_format(path)
+    source = os.path.basename(path)
+    result = {'imported': 0, 'rejected': 0, 'errors': [], 'first_id': None, 'last_id': None}
+
+    if envelope is None:
+        envelope = ENVELOPE_ENCRYPTION
+    manager = get_key_manager()
+    key, kek_version = manager.key, manager.current_version
+    get_index_key()     # create it before the workers need it
+    if not encrypt:
+        key_version = PLAINTEXT
+    else:
+        key_version = ENVELOPE if envelope else kek_version
+    workers = (workers or os.cpu_count() or 1) if encrypt else 1
+    policies = {}
+    started = time.monotonic()
+
+    def write(rows, results):
+        first_id, last_id = _write_import_batch(rows, results, key_version, kek_version, policies)
+        result['imported'] += len(results)
+        result['first_id'] = result['first_id'] or first_id
+        result['last_id'] = last_id
+        log_activity(user_id, role, 'bulk_import',
+                     f'Imported patients {first_id}-{last_id} ({len(results)} records) from {source}')
+        if progress:
+            elapsed = time.monotonic() - started
+            progress(result['imported'], result['rejected'],
+                     result['imported'] / elapsed if elapsed else 0.0)
+
+    with _open_import(path) as f:
+        batches = _import_batches(f, fmt, batch_size, result)
+
+        if workers == 1:
+            _init_worker(key, envelope)
+            for rows in batches:
+                write(rows, _prepare_import(rows, encrypt))
+        else:
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                     initializer=_init_worker, initargs=(key, envelope)) as pool:
+                # Keep a bounded number of batches in flight, write them in file order
+                in_flight = []
+                for rows in batches:
+                    in_flight.append((rows, pool.submit(_prepare_import, rows, encrypt)))
+                    if len(in_flight) >= workers * 2:
+                        rows, future = in_flight.pop(0)
+                        write(rows, future.result())
+                for rows, future in in_flight:
+                    write(rows, future.result())
+
+    elapsed = time.monotonic() - started
+    result.update(seconds=elapsed, rows_per_sec=result['imported'] / elapsed if elapsed else 0.0)
+    print(f"✅ Imported {result['imported']} patients from {source} "
+          f"({result['rejected']} rejected, {result['rows_per_sec']:.0f} rows/s)")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk patient data jobs")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    enc = sub.add_parser('encrypt', help="Encrypt all patient records")
+    enc.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    enc.add_argument('--chunk-size', type=int, default=ENCRYPT_CHUNK_SIZE)
+    enc.add_argument('--restart', action='store_true', help="Ignore the saved checkpoint")
+
+    rot = sub.add_parser('rotate', help="Rotate the encryption key and re-encrypt all records")
+    rot.add_argument('--resume', action='store_true', help="Finish an interrupted rotation without adding a key")
+    rot.add_argument('--chunk-size', type=int, default=ROTATE_CHUNK_SIZE)
+    rot.add_argument('--keep-old-keys', action='store_true', help="Don't remove old keys from secret.key")
+
+    sub.add_parser('index', help="Build blind search indexes for existing records")
+
+    imp = sub.add_parser('import', help="Bulk-load patients from a CSV or JSONL file (.gz ok)")
+    imp.add_argument('path')
+    imp.add_argument('--format', choices=['csv', 'jsonl'], help="Default: from the file extension")
+    imp.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    imp.add_argument('--encrypt', action='store_true', help="Encrypt records before they are stored")
+    imp.add_argument('--workers', type=int, default=None, help="Encryption processes (default: CPU count)")
+    imp.add_argument('--user-id', type=int, default=0, help="User the audit events are recorded for")
+
+    arc = sub.add_parser('archive-logs', help="Move old audit events into compressed monthly segments")
+    arc.add_argument('--older-than-days', type=int, default=LOG_ARCHIVE_AGE_DAYS)
+
+    sub.add_parser('sweep-retention', help="Delete expired patient records in small batches")
+
+    ver = sub.add_parser('verify-logs', help="Check the audit log hash chain since the last checkpoint")
+    ver.add_argument('--full', action='store_true', help="Rehash the whole chain, including archives")
+
+    exp = sub.add_parser('export-logs', help="Stream the audit log to a CSV file (.gz to compress)")
+    exp.add_argument('output')
+    exp.add_argument('--user-id', type=int)
+    exp.add_argument('--role')
+    exp.add_argument('--action')
+    exp.add_argument('--from', dest='date_from', help="YYYY-MM-DD (inclusive)")
+    exp.add_argument('--to', dest='date_to', help="YYYY-MM-DD (inclusive)")
+
+    args = parser.parse_args()
+    run_migrations(check_plans=False)
+
+    if args.command == 'encrypt':
+        def show_progress(done, total, encrypted, rate):
+            print(f"  {done}/{total} rows scanned, {encrypted} encrypted ({rate:.0f} rows/s)")
+
+        encrypt_all_patients(args.workers, args.chunk_size, args.restart, show_progress)
+
+    elif args.command == 'rotate':
+        if not args.resume:
+            version = get_key_manager().add_key()
+            print(f"🔑 Added key version {version}")
+
+        def show_progress(done, total, rotated, rate):
+            print(f"  {done}/{total} rows, {rotated} rotated ({rate:.0f} rows/s)")
+
+        rotate_encryption_key(args.chunk_size, retire_old_keys=not args.keep_old_keys,
+                              progress=show_progress)
+
+    elif args.command == 'index':
+        build_blind_indexes()
+
+    elif args.command == 'import':
+        def show_progress(imported, rejected, rate):
+            print(f"  {imported} imported, {rejected} rejected ({rate:.0f} rows/s)")
+
+        result = import_patients(args.path, user_id=args.user_id, fmt=args.format,
+                                 batch_size=args.batch_size, encrypt=args.encrypt,
+                                 workers=args.workers, progress=show_progress)
+        for error in result['errors']:
+            print(f"  ⚠️ {error}")
+
+    elif args.command == 'sweep-retention':
+        def show_progress(deleted, rate):
+            print(f"  {deleted} deleted ({rate:.0f} rows/s)")
+
+        print(f"⏰ {retention_lag_days()} days behind the retention policy")
+        result = sweep_expired_data(progress=show_progress)
+        print(f"✅ Deleted {result['deleted']} expired records in {result['seconds']:.1f}s")
+
+    elif args.command == 'verify-logs':
+        result = verify_audit_log(full=args.full)
+        if result['ok']:
+            print(f"✅ Audit log intact: {result['checked']} events checked "
+                  f"({result['from_log_id']}..{result['to_log_id']}) in {result['seconds']:.2f}s")
+        else:
+            print(f"❌ Audit log integrity check failed: {result['error']}")
+            raise SystemExit(1)
+
+    elif args.command == 'archive-logs':
+        # Archive only what the integrity check has covered
+        result = verify_audit_log()
+        if not result['ok']:
+            print(f"❌ Not archiving - audit log integrity check failed: {result['error']}")
+            raise SystemExit(1)
+        count = archive_audit_logs(args.older_than_days)
+        print(f"✅ Archived {count} audit events")
+
+    elif args.command == 'export-logs':
+        size = export_audit_logs(args.output, user_id=args.user_id, role=args.role, action=args.action,
+                                 date_from=args.date_from, date_to=args.date_to)
+        print(f"✅ Exported audit log to {args.output} ({size / 1024:.0f} KB)")
+
+
+if __name__ == "__main__":
+    main()
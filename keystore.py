@@ -0,0 +1,252 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from cryptography.fernet import Fernet, MultiFernet
+from setup import setup_encryption_key
+
+KEY_FILE = 'secret.key'
+
+# patients.key_version values: 0 = plaintext, N = encrypted with key version N,
+# -1 = envelope-encrypted with the data key in patients.data_key_id,
+# -2 = erased (key destroyed, row waiting for compaction)
+PLAINTEXT = 0
+ENVELOPE = -1
+ERASED = -2
+
+# How often (seconds) to stat the key file for changes
+KEY_CHECK_INTERVAL = 1.0
+
+# Separate HMAC key for blind indexes - it must not change when the
+# encryption key is rotated, or every index value would change with it
+INDEX_KEY_FILE = 'index.key'
+BLIND_INDEX_HEX_CHARS = 32    # 128-bit truncated HMAC-SHA256
+
+# HMAC key that signs audit log checkpoints
+AUDIT_KEY_FILE = 'audit.key'
+
+
+def parse_keyring(content):
+    """
+    Parse secret.key contents into {version: key}
+    Each line is '<version>:<key>'; a bare key (the original single-key
+    format written by setup.py) is version 1.
+    """
+    keys = {}
+    for line in content.decode().splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if ':' in line:
+            version, key = line.split(':', 1)
+            keys[int(version)] = key.encode()
+        else:
+            keys[1] = line.encode()
+    return keys
+
+
+def format_keyring(keys):
+    return ''.join(f"{version}:{keys[version].decode()}\n" for version in sorted(keys)).encode()
+
+
+class KeyManager:
+    """
+    Holds the keyring from secret.key in memory
+    The key file is only re-read when its mtime or inode changes, so
+    encrypting a field costs one cipher call instead of a file read.
+    The newest key encrypts; every key in the ring can decrypt
+    (MultiFernet), so reads keep working while a rotation is running.
+    """
+
+    def __init__(self, path=KEY_FILE):
+        self.path = path
+        self._fernet = None
+        self._keys = {}
+        self._signature = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            print("⚠️ Key file not found. Generating new key...")
+            content = setup_encryption_key()
+        self._keys = parse_keyring(content)
+        # Newest key first: MultiFernet encrypts with the first key
+        self._fernet = MultiFernet([Fernet(self._keys[v]) for v in sorted(self._keys, reverse=True)])
+        self._signature = self._file_signature()
+
+    def get_fernet(self):
+        """Get the cached cipher, reloading it if the key file was replaced"""
+        now = time.monotonic()
+        if self._fernet is not None and now - self._checked_at < KEY_CHECK_INTERVAL:
+            return self._fernet
+
+        with self._lock:
+            if self._fernet is None or self._file_signature() != self._signature:
+                self._load()
+            self._checked_at = now
+            return self._fernet
+
+    def current(self):
+        """
+        Re-read the keyring if the file changed and return (cipher, current version)
+        Writers call this inside their write transaction, so new ciphertext
+        is never committed under a version a rotation has just retired.
+        """
+        with self._lock:
+            if self._fernet is None or self._file_signature() != self._signature:
+                self._load()
+            self._checked_at = time.monotonic()
+            return self._fernet, max(self._keys)
+
+    def refresh(self):
+        """Re-check the key file on the next call (after writing it)"""
+        self._checked_at = 0.0
+
+    @property
+    def current_version(self):
+        """Version of the key used for new ciphertext"""
+        self.get_fernet()
+        return max(self._keys)
+
+    @property
+    def versions(self):
+        self.get_fernet()
+        return sorted(self._keys)
+
+    @property
+    def key(self):
+        """Raw bytes of the current key (e.g. to hand to worker processes)"""
+        self.get_fernet()
+        return self._keys[max(self._keys)]
+
+    def add_key(self):
+        """
+        Generate a new current key and append it to the keyring
+        Returns: The new key version
+        """
+        with self._lock:
+            self._load()
+            version = max(self._keys) + 1
+            keys = dict(self._keys)
+            keys[version] = Fernet.generate_key()
+            self._write(keys)
+        self.refresh()
+        return version
+
+    def retire_keys(self, versions):
+        """Remove old key versions (only once no data uses them)"""
+        with self._lock:
+            self._load()
+            current = max(self._keys)
+            keys = {v: k for v, k in self._keys.items() if v not in versions or v == current}
+            self._write(keys)
+        self.refresh()
+
+    def _write(self, keys):
+        # Write to a temp file and swap it in so readers never see half a keyring
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(format_keyring(keys))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def wrap_key(self, data_key):
+        """
+        Encrypt a data key with the current master key
+        Returns: (wrapped key string, master key version)
+        """
+        # Cipher and version from one fresh snapshot of the keyring
+        fernet, version = self.current()
+        return fernet.encrypt(data_key).decode(), version
+
+    def unwrap_key(self, wrapped_key):
+        """Decrypt a wrapped data key and return a cipher for it"""
+        return Fernet(self.get_fernet().decrypt(wrapped_key.encode()))
+
+    def encrypt(self, data):
+        """Encrypt one string (None/empty stays None)"""
+        if not data:
+            return None
+        return self.get_fernet().encrypt(data.encode()).decode()
+
+    def decrypt(self, encrypted_data):
+        """Decrypt one string (None/empty stays None)"""
+        if not encrypted_data:
+            return None
+        return self.get_fernet().decrypt(encrypted_data.encode()).decode()
+
+    def encrypt_many(self, values):
+        """Encrypt a sequence of strings with a single key lookup"""
+        fernet = self.get_fernet()
+        return [fernet.encrypt(v.encode()).decode() if v else None for v in values]
+
+    def decrypt_many(self, values):
+        """Decrypt a sequence of strings with a single key lookup"""
+        fernet = self.get_fernet()
+        return [fernet.decrypt(v.encode()).decode() if v else None for v in values]
+
+    def rotate_many(self, values):
+        """Re-encrypt tokens under the current key (None/empty stays as is)"""
+        fernet = self.get_fernet()
+        return [fernet.rotate(v.encode()).decode() if v else v for v in values]
+
+
+_manager = KeyManager()
+_hmac_keys = {}
+_hmac_keys_lock = threading.Lock()
+
+
+def get_key_manager():
+    """Get the process-wide key manager"""
+    return _manager
+
+
+def _get_hmac_key(path, label):
+    """Load (or create on first use) a 256-bit HMAC key file"""
+    if path not in _hmac_keys:
+        with _hmac_keys_lock:
+            if path not in _hmac_keys:
+                try:
+                    with open(path, 'rb') as f:
+                        _hmac_keys[path] = base64.urlsafe_b64decode(f.read().strip())
+                except FileNotFoundError:
+                    print(f"🔐 Generating {label} key...")
+                    key = os.urandom(32)
+                    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(base64.urlsafe_b64encode(key))
+                    _hmac_keys[path] = key
+    return _hmac_keys[path]
+
+
+def get_index_key():
+    """Load (or create on first use) the blind-index HMAC key"""
+    return _get_hmac_key(INDEX_KEY_FILE, "blind index")
+
+
+def get_audit_key():
+    """Load (or create on first use) the audit checkpoint signing key"""
+    return _get_hmac_key(AUDIT_KEY_FILE, "audit checkpoint")
+
+
+def blind_index(normalized_value):
+    """Keyed hash of an already-normalized value (None stays None)"""
+    if not normalized_value:
+        return None
+    digest = hmac.new(get_index_key(), normalized_value.encode(), hashlib.sha256).hexdigest()
+    return digest[:BLIND_INDEX_HEX_CHARS]
@@ -0,0 +1,592 @@
+# migrations.py - Versioned schema migrations
+#
+# Usage: python migrations.py            apply pending migrations
+#        python migrations.py status     show the current schema version
+#        python migrations.py check      verify hot queries use their indexes
+
+import re
+import sys
+from database import get_connection, transaction
+from keystore import PLAINTEXT, ERASED
+
+
+class QueryPlanError(Exception):
+    """A hot query no longer uses the index it depends on"""
+
+
+def add_column(conn, table, column, definition):
+    """
+    ALTER TABLE ... ADD COLUMN unless the column already exists
+    Returns: True if the column was added
+    """
+    existing_columns = [col[1] for col in conn.execute(f"PRAGMA table_info({table})")]
+    if column in existing_columns:
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+
+# ---------- migrations (append only - never edit one that has shipped) ----------
+
+def _patient_columns(conn):
+    # Base tables as the original schema created them (data_keys is
+    # missing from databases created before envelope encryption), then
+    # the GDPR, encryption and search columns
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            password TEXT NOT NULL,
+            role TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS patients (
+            patient_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            contact TEXT NOT NULL,
+            diagnosis TEXT,
+            anonymized_name TEXT,
+            anonymized_contact TEXT,
+            date_added DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS logs (
+            log_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            action TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            details TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS data_keys (
+            key_id INTEGER PRIMARY KEY,
+            wrapped_key TEXT NOT NULL,
+            kek_version INTEGER NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_data_keys_kek_version ON data_keys(kek_version)")
+    add_column(conn, 'patients', 'consent_given', "INTEGER DEFAULT 0")
+    add_column(conn, 'patients', 'retention_date', "TEXT")
+    if add_column(conn, 'patients', 'key_version', "INTEGER NOT NULL DEFAULT 0"):
+        # Rows encrypted before the column existed hold Fernet tokens
+        conn.execute("UPDATE patients SET key_version = 1 WHERE name LIKE 'gAAAAA%'")
+    add_column(conn, 'patients', 'data_key_id', "INTEGER REFERENCES data_keys(key_id)")
+    add_column(conn, 'patients', 'name_index', "TEXT")
+    add_column(conn, 'patients', 'contact_index', "TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_key_version ON patients(key_version)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_name_index ON patients(name_index)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_contact_index ON patients(contact_index)")
+
+
+def _log_indexes(conn):
+    # Audit Logs tab (ORDER BY timestamp DESC) and the 7-day activity chart
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs(timestamp)")
+    # Per-user and per-action history
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_user_timestamp ON logs(user_id, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_action_timestamp ON logs(action, timestamp)")
+
+
+def _retention_index(conn):
+    # Most patients have no retention date - keep them out of the index
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_patients_retention_date
+        ON patients(retention_date)
+        WHERE retention_date IS NOT NULL
+    """)
+
+
+def _activity_rollup(conn):
+    # Maintained by audit.write_events; backfilled here from existing logs
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS activity_rollup (
+            day TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            role TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (day, hour, action, role)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("DELETE FROM activity_rollup")
+    conn.execute("""
+        INSERT INTO activity_rollup (day, hour, action, role, count)
+        SELECT DATE(timestamp), CAST(strftime('%H', timestamp) AS INTEGER),
+               action, role, COUNT(*)
+        FROM logs
+        GROUP BY 1, 2, action, role
+    """)
+
+
+def _compact_logs(conn):
+    # Dictionary-encoded action/role and epoch-millisecond timestamps
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS log_actions (
+            action_id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS log_roles (
+            role_id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS log_events (
+            log_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL REFERENCES users(user_id),
+            role_id INTEGER NOT NULL REFERENCES log_roles(role_id),
+            action_id INTEGER NOT NULL REFERENCES log_actions(action_id),
+            ts_ms INTEGER NOT NULL,
+            details TEXT
+        )
+    """)
+
+    is_table = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'logs'"
+    ).fetchone()
+    if is_table:
+        conn.execute("INSERT OR IGNORE INTO log_actions (name) SELECT DISTINCT action FROM logs")
+        conn.execute("INSERT OR IGNORE INTO log_roles (name) SELECT DISTINCT role FROM logs")
+        conn.execute("""
+            INSERT INTO log_events (log_id, user_id, role_id, action_id, ts_ms, details)
+            SELECT l.log_id, l.user_id, r.role_id, a.action_id,
+                   COALESCE(CAST(strftime('%s', l.timestamp) AS INTEGER), 0) * 1000,
+                   l.details
+            FROM logs l
+            JOIN log_roles r ON r.name = l.role
+            JOIN log_actions a ON a.name = l.action
+        """)
+        conn.execute("DROP TABLE logs")
+
+    # Compatibility view: same columns (and text timestamps) as the old table
+    conn.execute("""
+        CREATE VIEW IF NOT EXISTS logs AS
+        SELECT e.log_id, e.user_id, r.name AS role, a.name AS action,
+               strftime('%Y-%m-%d %H:%M:%S', e.ts_ms / 1000, 'unixepoch') AS timestamp,
+               e.details, e.ts_ms
+        FROM log_events e
+        JOIN log_roles r ON r.role_id = e.role_id
+        JOIN log_actions a ON a.action_id = e.action_id
+    """)
+    # Old-style INSERT INTO logs (...) keeps working (and keeps the rollup in step)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS logs_insert INSTEAD OF INSERT ON logs
+        BEGIN
+            INSERT OR IGNORE INTO log_roles (name) VALUES (NEW.role);
+            INSERT OR IGNORE INTO log_actions (name) VALUES (NEW.action);
+            INSERT INTO log_events (user_id, role_id, action_id, ts_ms, details)
+            VALUES (
+                NEW.user_id,
+                (SELECT role_id FROM log_roles WHERE name = NEW.role),
+                (SELECT action_id FROM log_actions WHERE name = NEW.action),
+                COALESCE(CAST(strftime('%s', NEW.timestamp) AS INTEGER) * 1000,
+                         CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)),
+                NEW.details
+            );
+            INSERT INTO activity_rollup (day, hour, action, role, count)
+            SELECT strftime('%Y-%m-%d', ts_ms / 1000, 'unixepoch'),
+                   CAST(strftime('%H', ts_ms / 1000, 'unixepoch') AS INTEGER),
+                   NEW.action, NEW.role, 1
+            FROM log_events WHERE log_id = last_insert_rowid()
+            ON CONFLICT (day, hour, action, role) DO UPDATE SET count = count + 1;
+        END
+    """)
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_log_events_ts ON log_events(ts_ms)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_log_events_user_ts ON log_events(user_id, ts_ms)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_log_events_action_ts ON log_events(action_id, ts_ms)")
+
+
+# Actions whose free-text details name the patient they touched
+_PATIENT_DETAIL_ACTIONS = ('add_patient', 'encrypt_data', 'decrypt_data', 'set_retention', 'erase_patient')
+
+
+def _log_targets(conn):
+    # Structured subject of each audit event, e.g. ('patient', 12)
+    add_column(conn, 'log_events', 'target_type', "TEXT")
+    add_column(conn, 'log_events', 'target_id', "INTEGER")
+
+    # Backfill from details such as 'Added patient 12: ...'
+    placeholders = ','.join('?' * len(_PATIENT_DETAIL_ACTIONS))
+    rows = conn.execute(f"""
+        SELECT e.log_id, e.details
+        FROM log_events e
+        JOIN log_actions a ON a.action_id = e.action_id
+        WHERE a.name IN ({placeholders})
+    """, _PATIENT_DETAIL_ACTIONS).fetchall()
+    targets = []
+    for log_id, details in rows:
+        match = re.search(r'patient (\d+)', details or '')
+        if match:
+            targets.append((int(match.group(1)), log_id))
+    conn.executemany(
+        "UPDATE log_events SET target_type = 'patient', target_id = ? WHERE log_id = ?",
+        targets
+    )
+
+    # 'Added patient 12: John Doe' -> 'Added patient 12', as add_patient now
+    # logs it: the name must not outlive an erasure in the (soon chained) log
+    conn.execute("""
+        UPDATE log_events
+        SET details = substr(details, 1, instr(details, ':') - 1)
+        WHERE action_id = (SELECT action_id FROM log_actions WHERE name = 'add_patient')
+          AND details LIKE 'Added patient %:%'
+    """)
+
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_log_events_target
+        ON log_events(target_type, target_id, ts_ms)
+        WHERE target_id IS NOT NULL
+    """)
+
+    # Dropping the view also drops its INSTEAD OF trigger
+    conn.execute("DROP VIEW IF EXISTS logs")
+    conn.execute("""
+        CREATE VIEW logs AS
+        SELECT e.log_id, e.user_id, r.name AS role, a.name AS action,
+               strftime('%Y-%m-%d %H:%M:%S', e.ts_ms / 1000, 'unixepoch') AS timestamp,
+               e.details, e.ts_ms, e.target_type, e.target_id
+        FROM log_events e
+        JOIN log_roles r ON r.role_id = e.role_id
+        JOIN log_actions a ON a.action_id = e.action_id
+    """)
+    conn.execute("""
+        CREATE TRIGGER logs_insert INSTEAD OF INSERT ON logs
+        BEGIN
+            INSERT OR IGNORE INTO log_roles (name) VALUES (NEW.role);
+            INSERT OR IGNORE INTO log_actions (name) VALUES (NEW.action);
+            INSERT INTO log_events (user_id, role_id, action_id, ts_ms, details, target_type, target_id)
+            VALUES (
+                NEW.user_id,
+                (SELECT role_id FROM log_roles WHERE name = NEW.role),
+                (SELECT action_id FROM log_actions WHERE name = NEW.action),
+                COALESCE(CAST(strftime('%s', NEW.timestamp) AS INTEGER) * 1000,
+                         CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)),
+                NEW.details, NEW.target_type, NEW.target_id
+            );
+            INSERT INTO activity_rollup (day, hour, action, role, count)
+            SELECT strftime('%Y-%m-%d', ts_ms / 1000, 'unixepoch'),
+                   CAST(strftime('%H', ts_ms / 1000, 'unixepoch') AS INTEGER),
+                   NEW.action, NEW.role, 1
+            FROM log_events WHERE log_id = last_insert_rowid()
+            ON CONFLICT (day, hour, action, role) DO UPDATE SET count = count + 1;
+        END
+    """)
+
+
+def _log_archive_manifest(conn):
+    # One row per immutable segment file written by archive.archive_audit_logs
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS log_archive_segments (
+            segment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            month TEXT NOT NULL,
+            path TEXT NOT NULL UNIQUE,
+            first_ts INTEGER NOT NULL,
+            last_ts INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_log_archive_segments_ts ON log_archive_segments(last_ts)")
+    # Which segments mention a target, so access history opens only those
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS log_archive_targets (
+            target_type TEXT NOT NULL,
+            target_id INTEGER NOT NULL,
+            segment_id INTEGER NOT NULL REFERENCES log_archive_segments(segment_id),
+            PRIMARY KEY (target_type, target_id, segment_id)
+        ) WITHOUT ROWID
+    """)
+
+
+def _audit_hash_chain(conn):
+    # Keyed (HMAC) chain, with a signed checkpoint at every
+    # AUDIT_CHECKPOINT_INTERVAL-th event so a missing one is detectable
+    from integrity import chain_hash, save_checkpoint, GENESIS_HASH, AUDIT_CHECKPOINT_INTERVAL
+
+    add_column(conn, 'log_events', 'entry_hash', "TEXT")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS audit_chain_head (
+            last_log_id INTEGER NOT NULL,
+            last_hash TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS audit_checkpoints (
+            checkpoint_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            log_id INTEGER NOT NULL,
+            entry_hash TEXT NOT NULL,
+            signature TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            verified_at DATETIME
+        )
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_audit_checkpoints_log_id ON audit_checkpoints(log_id)")
+
+    # Events must go through the audit writer to be chained
+    conn.execute("DROP TRIGGER IF EXISTS logs_insert")
+
+    # The chain starts after the last event that has already been archived
+    genesis_id = conn.execute("""
+        SELECT COALESCE(MIN(log_id) - 1,
+                        (SELECT seq FROM sqlite_sequence WHERE name = 'log_events'), 0)
+        FROM log_events
+    """).fetchone()[0]
+    save_checkpoint(conn, genesis_id, GENESIS_HASH, verified=True)
+
+    last_id, last_hash = genesis_id, GENESIS_HASH
+    rows = conn.execute("""
+        SELECT e.log_id, e.user_id, r.name, a.name, e.ts_ms, e.details, e.target_type, e.target_id
+        FROM log_events e
+        JOIN log_roles r ON r.role_id = e.role_id
+        JOIN log_actions a ON a.action_id = e.action_id
+        ORDER BY e.log_id
+    """).fetchall()
+    hashes = []
+    for log_id, *fields in rows:
+        last_id = log_id
+        last_hash = chain_hash(last_hash, log_id, *fields)
+        hashes.append((last_hash, log_id))
+        if log_id % AUDIT_CHECKPOINT_INTERVAL == 0:
+            save_checkpoint(conn, log_id, last_hash)
+    conn.executemany("UPDATE log_events SET entry_hash = ? WHERE log_id = ?", hashes)
+
+    conn.execute("DELETE FROM audit_chain_head")
+    conn.execute("INSERT INTO audit_chain_head VALUES (?, ?)", (last_id, last_hash))
+
+
+def _retention_policies(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS retention_policies (
+            policy_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            diagnosis_pattern TEXT,
+            retention_days INTEGER NOT NULL CHECK (retention_days > 0),
+            priority INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # NULL = no policy (no retention date, or one set by hand)
+    add_column(conn, 'patients', 'retention_policy_id', "INTEGER REFERENCES retention_policies(policy_id)")
+
+
+
+def _inline_anonymization(conn):
+    # add_patient now writes the masked columns in its INSERT; bring rows
+    # left unmasked by the old INSERT-then-UPDATE path up to the same state
+    import privacy      # registers anonymize_name / mask_contact
+    conn = get_connection()     # installs them on this connection
+    conn.execute("""
+        UPDATE patients
+        SET anonymized_name = anonymize_name(patient_id),
+            anonymized_contact = CASE WHEN key_version = 0
+                                      THEN mask_contact(contact)
+                                      ELSE anonymized_contact END
+        WHERE anonymized_name IS NOT anonymize_name(patient_id)
+           OR (key_version = 0 AND anonymized_contact IS NOT mask_contact(contact))
+    """)
+
+
+
+def _role_views(conn):
+    # Per-role read path: masks are computed at read time by the
+    # registered functions, so a masking rule change rewrites nothing.
+    # Encrypted contacts can't be masked - they keep the stored mask
+    # taken before encryption. The erased-row filter can't use
+    # idx_patients_key_version (unary +), so keyset pages walk the
+    # patient_id primary key instead of scanning and sorting.
+    masked = f"""
+        anonymize_name(patient_id) AS anonymized_name,
+        CASE WHEN key_version = {PLAINTEXT} THEN mask_contact(contact)
+             ELSE anonymized_contact END AS anonymized_contact
+    """
+    role_columns = {
+        'admin': f"patient_id, name, contact, diagnosis, {masked}, date_added",
+        'doctor': f"patient_id, {masked}, diagnosis, date_added",
+        'receptionist': f"patient_id, {masked}, date_added"
+    }
+    for role, columns in role_columns.items():
+        conn.execute(f"DROP VIEW IF EXISTS patients_{role}")
+        conn.execute(f"""
+            CREATE VIEW patients_{role} AS
+            SELECT {columns}
+            FROM patients
+            WHERE +key_version != {ERASED}
+        """)
+
+
+def _job_checkpoints(conn):
+    # Resume points of the long-running jobs in jobs.py
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS job_checkpoints (
+            job_name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _log_role_index(conn):
+    # Audit log viewer's role filter
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_log_events_role_ts ON log_events(role_id, ts_ms)")
+
+
+MIGRATIONS = [
+    (1, "patient GDPR, encryption and search columns", _patient_columns),
+    (2, "audit log indexes", _log_indexes),
+    (3, "partial index on patients.retention_date", _retention_index),
+    (4, "activity rollup table", _activity_rollup),
+    (5, "compact audit log storage", _compact_logs),
+    (6, "audit event targets", _log_targets),
+    (7, "audit log archive manifest", _log_archive_manifest),
+    (8, "hash-chained audit log", _audit_hash_chain),
+    (9, "retention policies", _retention_policies),
+    (10, "anonymized columns written at insert time", _inline_anonymization),
+    (11, "per-role patient views with read-time masking", _role_views),
+    (12, "job checkpoints", _job_checkpoints),
+    (13, "audit log role index", _log_role_index),
+]
+
+
+# ---------- runner ----------
+
+def _ensure_version_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def get_schema_version():
+    """Highest migration applied to the database (0 if none)"""
+    with transaction() as conn:
+        _ensure_version_table(conn)
+    return get_connection().execute(
+        "SELECT COALESCE(MAX(version), 0) FROM schema_version"
+    ).fetchone()[0]
+
+
+def run_migrations(check_plans=False):
+    """
+    Apply pending migrations in order, each in its own transaction
+    Safe to call on every start-up: the version is re-read under the
+    write lock, so concurrent processes never apply a migration twice.
+    check_plans=True runs check_query_plans() afterwards (a diagnostic
+    for setup and CI - it raises QueryPlanError on a regression).
+
+    Returns: Number of migrations applied
+    """
+    applied = 0
+
+    for version, description, migrate in MIGRATIONS:
+        with transaction() as conn:
+            _ensure_version_table(conn)
+            current = conn.execute(
+                "SELECT COALESCE(MAX(version), 0) FROM schema_version"
+            ).fetchone()[0]
+            if version <= current:
+                continue
+
+            migrate(conn)
+            conn.execute("""
+                INSERT INTO schema_version (version, description)
+                VALUES (?, ?)
+            """, (version, description))
+
+        applied += 1
+        print(f"✅ Applied migration {version}: {description}")
+
+    if applied:
+        # Refresh statistics only where they are missing or stale
+        get_connection().execute("PRAGMA optimize")
+
+    if check_plans:
+        check_query_plans()
+
+    return applied
+
+
+# ---------- query plan self-check ----------
+
+# (description, query, parameters, index the plan must use)
+HOT_QUERIES = [
+    ("audit log viewer",
+     "SELECT * FROM logs ORDER BY ts_ms DESC LIMIT 50", (),
+     'idx_log_events_ts'),
+    ("activity chart",
+     "SELECT day, action, SUM(count) FROM activity_rollup WHERE day >= date('now', ?) GROUP BY day, action",
+     ('-365 days',), 'PRIMARY KEY'),
+    ("per-user activity",
+     "SELECT * FROM logs WHERE user_id = ? ORDER BY ts_ms DESC", (1,),
+     'idx_log_events_user_ts'),
+    ("per-role activity",
+     "SELECT * FROM logs WHERE role = ? ORDER BY ts_ms DESC, log_id DESC LIMIT 101", ('admin',),
+     'idx_log_events_role_ts'),
+    ("per-action activity",
+     "SELECT * FROM logs WHERE action = ? AND ts_ms >= ?", ('login successful', 0),
+     'idx_log_events_action_ts'),
+    ("patient access history",
+     "SELECT * FROM logs WHERE target_type = 'patient' AND target_id = ? ORDER BY ts_ms DESC", (1,),
+     'idx_log_events_target'),
+    ("expired patients",
+     "SELECT patient_id FROM patients WHERE retention_date IS NOT NULL AND retention_date <= ?", ('2000-01-01',),
+     'idx_patients_retention_date'),
+    ("plaintext rows for bulk encryption",
+     "SELECT patient_id FROM patients WHERE key_version = 0 AND patient_id > ? ORDER BY patient_id LIMIT 100", (0,),
+     'idx_patients_key_version'),
+    ("patient page through a role view",
+     "SELECT * FROM patients_doctor WHERE patient_id > ? ORDER BY patient_id LIMIT 51", (0,),
+     'INTEGER PRIMARY KEY'),
+    ("blind index name lookup",
+     "SELECT patient_id FROM patients WHERE name_index = ?", ('x',),
+     'idx_patients_name_index'),
+    ("blind index contact lookup",
+     "SELECT patient_id FROM patients WHERE contact_index = ?", ('x',),
+     'idx_patients_contact_index'),
+]
+
+
+def check_query_plans():
+    """
+    EXPLAIN QUERY PLAN every hot query and fail if one regressed
+    Raises QueryPlanError if a query no longer uses its index or falls
+    back to a full table scan.
+    """
+    import privacy      # registers the masking functions the role views call
+    conn = get_connection()
+    problems = []
+
+    for description, query, params, index in HOT_QUERIES:
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+        full_scans = [step for step in plan if step.startswith('SCAN') and 'INDEX' not in step]
+
+        if full_scans or not any(index in step for step in plan):
+            problems.append(f"{description}: {'; '.join(plan)}")
+
+    if problems:
+        raise QueryPlanError("Hot queries regressed:\n  " + "\n  ".join(problems))
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else 'migrate'
+
+    if command == 'status':
+        print(f"Schema version: {get_schema_version()} (latest: {MIGRATIONS[-1][0]})")
+    elif command == 'check':
+        check_query_plans()
+        print(f"✅ All {len(HOT_QUERIES)} hot queries use their indexes")
+    else:
+        count = run_migrations()
+        print(f"✅ Schema up to date (version {get_schema_version()}, {count} applied)")
+        print("ℹ️ Run 'python migrations.py check' to verify the hot query plans")
@@ -1,10 +1,81 @@
-import sqlite3
-import hashlib
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
 from auth import log_activity  # Import for logging
-import os
-from datetime import datetime
-from setup import setup_encryption_key
+from audit import TARGET_PATIENT
+import threading
+import time
+from datetime import datetime, timedelta
+from database import get_connection, transaction, register_sql_function, iter_rows, STREAM_CHUNK_SIZE
+from cache import cached_query
+from keystore import get_key_manager, blind_index, PLAINTEXT, ENVELOPE, ERASED
+
+# Rows updated per transaction by the bulk anonymization engine
+ANONYMIZE_CHUNK_SIZE = 5000
+
+# Encrypt new records with their own data key (wrapped by the master key),
+# so rotating the master key only re-wraps the data_keys table
+ENVELOPE_ENCRYPTION = True
+
+# Erased rows physically removed per transaction by the background compaction
+COMPACTION_CHUNK_SIZE = 500
+
+# Patients per page for the dashboards (keyset pagination)
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# View each role reads patients through (migration 11): only the columns
+# the role may see, masked at read time, erased rows left out
+ROLE_VIEWS = {
+    'admin': 'patients_admin',
+    'doctor': 'patients_doctor',
+    'receptionist': 'patients_receptionist'
+}
+
+# Retention sweeper: expired rows deleted per transaction, pause between
+# batches so interactive writers get the lock, and seconds between runs
+RETENTION_CHUNK_SIZE = 500
+RETENTION_PAUSE = 0.05
+RETENTION_SWEEP_INTERVAL = 3600
+
+# Rows re-evaluated per transaction when applying retention policies
+RETENTION_POLICY_CHUNK_SIZE = 20000
+
+# Best retention policy for the current patients row: highest priority
+# first; diagnosis patterns (LIKE) can only match plaintext rows, so
+# encrypted rows keep the policy they were given while still readable
+POLICY_MATCH_SQL = f"""
+    SELECT p.policy_id, date(patients.date_added, '+' || p.retention_days || ' days')
+    FROM retention_policies p
+    WHERE CASE 
+        WHEN patients.key_version = {PLAINTEXT}
+            THEN p.diagnosis_pattern IS NULL OR patients.diagnosis LIKE p.diagnosis_pattern
+        WHEN EXISTS (SELECT 1 FROM retention_policies q WHERE q.policy_id = patients.retention_policy_id)
+            THEN p.policy_id = patients.retention_policy_id
+        ELSE p.diagnosis_pattern IS NULL
+    END
+    ORDER BY p.priority DESC, p.policy_id
+    LIMIT 1
+"""
+
+# Best retention policy for a plaintext :diagnosis (POLICY_MATCH_SQL for a new row)
+DIAGNOSIS_POLICY_SQL = """
+    SELECT policy_id, retention_days
+    FROM retention_policies
+    WHERE diagnosis_pattern IS NULL OR :diagnosis LIKE diagnosis_pattern
+    ORDER BY priority DESC, policy_id
+    LIMIT 1
+"""
+
+# Next patient_id, allocated inside the write transaction so the
+# anonymized name can be written by the INSERT itself; ids of deleted
+# patients are never handed out again (AUTOINCREMENT semantics)
+NEXT_PATIENT_ID_SQL = """
+    SELECT MAX(COALESCE((SELECT MAX(patient_id) FROM patients), 0),
+               COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'patients'), 0)) + 1 AS patient_id
+"""
+
+# Phone numbers are matched on their last N digits ('0300-...' == '+92-300-...')
+PHONE_SIGNIFICANT_DIGITS = 10
+INDEX_CHUNK_SIZE = 1000
 
 def anonymize_name(patient_id):
     """
@@ -32,16 +103,56 @@ def mask_contact(contact):
         return "XXX-XXX-XXXX"
 
 
+def normalize_name(name):
+    """
+    Normalize a name for exact-match search
+    Example: '  john   DOE ' → 'john doe'
+    """
+    if not name:
+        return None
+    return ' '.join(name.split()).casefold()
+
+
+def normalize_contact(contact):
+    """
+    Normalize a phone number for search
+    Example: '+92-300-1234567' and '0300 1234567' → '3001234567'
+    """
+    if not contact:
+        return None
+    digits_only = ''.join(filter(str.isdigit, contact))
+    return digits_only[-PHONE_SIGNIFICANT_DIGITS:] or None
+
+
+def name_index(name):
+    """Blind index (keyed hash) of a patient name"""
+    return blind_index(normalize_name(name))
+
+
+def contact_index(contact):
+    """Blind index (keyed hash) of a contact number"""
+    return blind_index(normalize_contact(contact))
+
+
+# Make the masking rules callable from SQL on every connection
+register_sql_function('anonymize_name', 1, anonymize_name)
+register_sql_function('mask_contact', 1, mask_contact)
+register_sql_function('name_index', 1, name_index)
+register_sql_function('contact_index', 1, contact_index)
+
+
 def anonymize_patient(patient_id):
     """
     Anonymize a specific patient's data in the database
     """
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
-    try:
+    with transaction() as conn:
+        cursor = conn.cursor()
+        
         # 1. Fetch patient's current data
-        cursor.execute("SELECT name, contact FROM patients WHERE patient_id = ?", (patient_id,))
+        cursor.execute("""
+            SELECT name, contact, anonymized_contact, key_version 
+            FROM patients WHERE patient_id = ?
+        """, (patient_id,))
         patient = cursor.fetchone()
         
         if patient is None:
@@ -49,8 +160,9 @@ def anonymize_patient(patient_id):
             return None
         
         # 2. Generate anonymized versions
+        # (an encrypted contact can't be masked - keep the mask taken before encryption)
         anon_name = anonymize_name(patient_id)
-        anon_contact = mask_contact(patient[1])
+        anon_contact = mask_contact(patient[1]) if patient[3] == PLAINTEXT else patient[2]
 
         # 3. UPDATE the patient record with anonymized data
         cursor.execute("""
@@ -59,105 +171,164 @@ def anonymize_patient(patient_id):
             WHERE patient_id = ?
         """, (anon_name, anon_contact, patient_id))
         
-        conn.commit()
         print(f"✅ Patient {patient_id} anonymized successfully!")
         return True
-        
-    finally:
-        conn.close()
 
 
-def anonymize_all_patients():
+def anonymize_all_patients(incremental=False, chunk_size=ANONYMIZE_CHUNK_SIZE, progress=None):
     """
     Anonymize ALL patients in the database
+    Runs set-based UPDATEs over patient_id (rowid) ranges, one short
+    transaction per chunk, with the masking done by the registered SQL
+    functions. incremental=True only touches rows whose anonymized
+    columns are missing or out of date (e.g. the contact was edited).
+    The role views mask at read time, so the dashboards don't depend on
+    this; the stored mask matters for contacts that get encrypted.
+    progress(done, total, updated) is called after every chunk.
+    
+    Returns: Number of patients updated
     """
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     
-    try:
-        # 1. Get ALL patient IDs
-        cursor.execute("SELECT patient_id FROM patients")
-        patients = cursor.fetchall()
-        
-        if not patients:
-            print("❌ No patients found in database!")
-            return
-        
-        # 2. Loop through each patient and anonymize
-        count = 0
-        for patient in patients:
-            patient_id = patient[0]
-            
-            # Fetch contact for this patient
-            cursor.execute("SELECT contact FROM patients WHERE patient_id = ?", (patient_id,))
-            result = cursor.fetchone()
-            
-            if result:
-                anon_name = anonymize_name(patient_id)
-                anon_contact = mask_contact(result[0])
-                
-                # Update this patient
-                cursor.execute("""
-                    UPDATE patients 
-                    SET anonymized_name = ?, anonymized_contact = ? 
-                    WHERE patient_id = ?
-                """, (anon_name, anon_contact, patient_id))
-                count += 1
+    # 1. Find the rowid range to sweep
+    cursor.execute("SELECT MIN(patient_id), MAX(patient_id) FROM patients")
+    first_id, last_id = cursor.fetchone()
+    
+    if first_id is None:
+        print("❌ No patients found in database!")
+        return 0
+    
+    # Encrypted contacts keep the mask computed before they were encrypted
+    query = """
+        UPDATE patients 
+        SET anonymized_name = anonymize_name(patient_id),
+            anonymized_contact = CASE WHEN key_version = 0
+                                      THEN mask_contact(contact)
+                                      ELSE anonymized_contact END
+        WHERE patient_id BETWEEN ? AND ?
+    """
+    if incremental:
+        query += """
+          AND (anonymized_name IS NOT anonymize_name(patient_id)
+               OR (key_version = 0 AND anonymized_contact IS NOT mask_contact(contact)))
+        """
+    
+    # 2. Update one chunk of rowids per transaction
+    total = last_id - first_id + 1
+    count = 0
+    for start in range(first_id, last_id + 1, chunk_size):
+        end = min(start + chunk_size - 1, last_id)
         
-        conn.commit()
-        print(f"✅ Successfully anonymized {count} patients!")
+        with transaction() as conn:
+            count += conn.execute(query, (start, end)).rowcount
         
-    finally:
-        conn.close()
+        if progress:
+            progress(end - first_id + 1, total, count)
+    
+    print(f"✅ Successfully anonymized {count} patients!")
+    return count
 
 
+@cached_query
 def get_patient_data(role):
     """
     Fetch patient data based on user role
+    Reads the role's view, which masks name and contact at read time.
     """
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
+    if role not in ROLE_VIEWS:
+        return []
     
-    try:
-        if role == 'admin':
-            query = """
-                SELECT patient_id, name, contact, diagnosis, 
-                       anonymized_name, anonymized_contact, date_added
-                FROM patients
-            """
-            
-        elif role == 'doctor':
-            query = """
-                SELECT patient_id, anonymized_name, anonymized_contact, 
-                       diagnosis, date_added
-                FROM patients
-            """
-            
-        elif role == 'receptionist':
-            query = """
-                SELECT patient_id, anonymized_name, anonymized_contact, 
-                       date_added
-                FROM patients
-            """
-        else:
-            return []
-        
-        # Execute query
-        cursor.execute(query)
-        
-        # Get column names
-        columns = [description[0] for description in cursor.description]
-        
-        # Fetch all rows
-        rows = cursor.fetchall()
-        
-        # Convert to list of dictionaries
-        data = [dict(zip(columns, row)) for row in rows]
-        
-        return data
-        
-    finally:
-        conn.close()
+    cursor = get_connection().cursor()
+    
+    # Execute query
+    cursor.execute(f"SELECT * FROM {ROLE_VIEWS[role]}")
+    
+    # Get column names
+    columns = [description[0] for description in cursor.description]
+    
+    # Fetch all rows
+    rows = cursor.fetchall()
+    
+    # Convert to list of dictionaries
+    data = [dict(zip(columns, row)) for row in rows]
+    
+    return data
+
+
+def iter_patient_data(role, chunk_size=STREAM_CHUNK_SIZE, chunked=False):
+    """
+    Stream patient data based on user role
+    Yields compact PatientRow namedtuples (or lists of them when
+    chunked=True) straight from the cursor, for exports and batch jobs
+    that must not hold the whole table in memory.
+    """
+    if role not in ROLE_VIEWS:
+        return iter(())
+    
+    query = f"""
+        SELECT *
+        FROM {ROLE_VIEWS[role]}
+        ORDER BY patient_id
+    """
+    return iter_rows(query, (), chunk_size, chunked, row_name='PatientRow')
+
+
+@cached_query
+def get_patient_page(role, cursor=None, page_size=PAGE_SIZE, descending=False,
+                     date_from=None, date_to=None):
+    """
+    Fetch one page of patient data based on user role
+    Uses keyset pagination on patient_id: pass the previous page's
+    next_cursor to get the following page, so every page costs an index
+    seek + page_size rows no matter how deep it is.
+    date_from/date_to ('YYYY-MM-DD') filter on date_added.
+    
+    Returns: Dictionary with rows (list of dicts), next_cursor (None on
+    the last page) and total_estimate (patients in the table, approximate)
+    """
+    if role not in ROLE_VIEWS:
+        return {'rows': [], 'next_cursor': None, 'total_estimate': 0}
+    
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    conditions = []
+    params = []
+    
+    if cursor is not None:
+        conditions.append("patient_id < ?" if descending else "patient_id > ?")
+        params.append(cursor)
+    if date_from:
+        conditions.append("date_added >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("date_added < date(?, '+1 day')")
+        params.append(date_to)
+    
+    db_cursor = get_connection().cursor()
+    
+    # Fetch one extra row to know whether another page follows
+    db_cursor.execute(f"""
+        SELECT *
+        FROM {ROLE_VIEWS[role]}
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ORDER BY patient_id {'DESC' if descending else 'ASC'}
+        LIMIT ?
+    """, params + [page_size + 1])
+    
+    columns = [description[0] for description in db_cursor.description]
+    rows = db_cursor.fetchall()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    
+    # Rowid range of the table: O(log n), unlike COUNT(*)
+    db_cursor.execute("SELECT MIN(patient_id), MAX(patient_id) FROM patients")
+    first_id, last_id = db_cursor.fetchone()
+    total_estimate = last_id - first_id + 1 if first_id is not None else 0
+    
+    return {
+        'rows': [dict(zip(columns, row)) for row in rows],
+        'next_cursor': rows[-1][0] if has_more else None,
+        'total_estimate': total_estimate
+    }
 
 
 def get_patient_by_id(patient_id, role):
@@ -166,124 +337,179 @@ def get_patient_by_id(patient_id, role):
     
     Returns: Dictionary with patient data or None
     """
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
+    if role not in ROLE_VIEWS:
+        return None
     
-    try:
-        if role == 'admin':
-            query = """
-                SELECT patient_id, name, contact, diagnosis, 
-                       anonymized_name, anonymized_contact, date_added
-                FROM patients WHERE patient_id = ?
-            """
-            
-        elif role == 'doctor':
-            query = """
-                SELECT patient_id, anonymized_name, anonymized_contact, 
-                       diagnosis, date_added
-                FROM patients WHERE patient_id = ?
-            """
-            
-        elif role == 'receptionist':
-            query = """
-                SELECT patient_id, anonymized_name, anonymized_contact, 
-                       date_added
-                FROM patients WHERE patient_id = ?
-            """
-        else:
-            return None
-        
-        # Execute query
-        cursor.execute(query, (patient_id,))
-        
-        # Get column names
-        columns = [description[0] for description in cursor.description]
-        
-        # Fetch the row
-        row = cursor.fetchone()
-        
-        if row is None:
-            return None
-        
-        # Convert to dictionary
-        data = dict(zip(columns, row))
-        
-        return data
-        
-    finally:
-        conn.close()
+    cursor = get_connection().cursor()
+    
+    # Execute query
+    cursor.execute(f"SELECT * FROM {ROLE_VIEWS[role]} WHERE patient_id = ?", (patient_id,))
+    
+    # Get column names
+    columns = [description[0] for description in cursor.description]
+    
+    # Fetch the row
+    row = cursor.fetchone()
+    
+    if row is None:
+        return None
+    
+    # Convert to dictionary
+    data = dict(zip(columns, row))
+    
+    return data
 
 
 def add_patient(name, contact, diagnosis, added_by_user_id):
     """
     Add a new patient to the database
-    Automatically anonymizes upon insertion
+    Automatically anonymizes upon insertion: the patient_id is allocated
+    inside the transaction, so the masked columns and the retention
+    policy are written by the INSERT itself (one row write).
     
     Returns: patient_id of newly created patient
     """
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
-    try:
-        # 1. INSERT new patient with name, contact, diagnosis
-        cursor.execute("""
-            INSERT INTO patients (name, contact, diagnosis)
-            VALUES (?, ?, ?)
-        """, (name, contact, diagnosis))
+    with transaction() as conn:
+        cursor = conn.cursor()
+        
+        # 1. INSERT the new patient, already anonymized, with search indexes and retention date
+        cursor.execute(f"""
+            INSERT INTO patients (patient_id, name, contact, diagnosis,
+                                  anonymized_name, anonymized_contact, name_index, contact_index,
+                                  retention_policy_id, retention_date)
+            SELECT new.patient_id, :name, :contact, :diagnosis,
+                   anonymize_name(new.patient_id), mask_contact(:contact), :name_index, :contact_index,
+                   policy.policy_id, date('now', '+' || policy.retention_days || ' days')
+            FROM ({NEXT_PATIENT_ID_SQL}) AS new
+            LEFT JOIN ({DIAGNOSIS_POLICY_SQL}) AS policy ON 1
+        """, {'name': name, 'contact': contact, 'diagnosis': diagnosis,
+              'name_index': name_index(name), 'contact_index': contact_index(contact)})
         
         # 2. Get the new patient_id
         new_patient_id = cursor.lastrowid
         
-        # 3. Automatically anonymize this new patient
-        anon_name = anonymize_name(new_patient_id)
-        anon_contact = mask_contact(contact)
-        
-        cursor.execute("""
-            UPDATE patients 
-            SET anonymized_name = ?, anonymized_contact = ? 
-            WHERE patient_id = ?
-        """, (anon_name, anon_contact, new_patient_id))
-        
-        conn.commit()
-        
-        # 4. Log the activity
+        # 3. Log the activity (the id only: audit events can't be erased later)
         log_activity(added_by_user_id, 'receptionist', 'add_patient', 
-                    f'Added patient {new_patient_id}: {name}')
+                    f'Added patient {new_patient_id}',
+                    target_type=TARGET_PATIENT, target_id=new_patient_id)
         
         print(f"✅ Patient {new_patient_id} added and anonymized successfully!")
         
-        # 5. Return the patient_id
+        # 4. Return the patient_id
         return new_patient_id
-        
-    finally:
-        conn.close()
-
 
-from datetime import datetime, timedelta
 
 def set_retention_period(patient_id, days=365):
     """
     Set data retention period for a patient
-    Default: 365 days (1 year)
+    Default: 365 days (1 year). A manual date overrides retention policies.
     """
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
-    try:
+    with transaction() as conn:
+        cursor = conn.cursor()
+        
         retention_date = (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d')
         
         cursor.execute("""
             UPDATE patients 
-            SET retention_date = ?
+            SET retention_date = ?, retention_policy_id = NULL
             WHERE patient_id = ?
         """, (retention_date, patient_id))
         
-        conn.commit()
         print(f"✅ Retention period set for patient {patient_id}: {retention_date}")
         return True
-        
-    finally:
-        conn.close()
+
+
+def add_retention_policy(name, retention_days, diagnosis_pattern=None, priority=0):
+    """
+    Create or update a retention policy
+    Records are kept retention_days after date_added. diagnosis_pattern
+    is a LIKE pattern (e.g. '%fracture%'); None matches every record.
+    When several policies match, the highest priority wins.
+    Call apply_retention_policies() to update existing records.
+    
+    Returns: policy_id
+    """
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO retention_policies (name, diagnosis_pattern, retention_days, priority)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET 
+                diagnosis_pattern = excluded.diagnosis_pattern,
+                retention_days = excluded.retention_days,
+                priority = excluded.priority
+        """, (name, diagnosis_pattern or None, retention_days, priority))
+        return conn.execute(
+            "SELECT policy_id FROM retention_policies WHERE name = ?", (name,)
+        ).fetchone()[0]
+
+
+def remove_retention_policy(name):
+    """Delete a retention policy (records fall back to the next matching one on apply)"""
+    with transaction() as conn:
+        return conn.execute("DELETE FROM retention_policies WHERE name = ?", (name,)).rowcount > 0
+
+
+def get_retention_policies():
+    """
+    List retention policies, highest priority first
+    Returns: List of dictionaries
+    """
+    cursor = get_connection().execute("""
+        SELECT policy_id, name, diagnosis_pattern, retention_days, priority
+        FROM retention_policies
+        ORDER BY priority DESC, policy_id
+    """)
+    columns = [description[0] for description in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def match_retention_policy(diagnosis, conn=None):
+    """
+    Best retention policy for a plaintext diagnosis (same rules as POLICY_MATCH_SQL)
+    Returns: (policy_id, retention_days) or None
+    """
+    return (conn or get_connection()).execute(
+        DIAGNOSIS_POLICY_SQL, {'diagnosis': diagnosis}
+    ).fetchone()
+
+
+def apply_retention_policies(chunk_size=RETENTION_POLICY_CHUNK_SIZE, progress=None):
+    """
+    Recompute retention dates for every policy-managed record
+    One set-based UPDATE per patient_id range: records without a
+    retention date get the best matching policy, policy-managed records
+    follow policy changes, and manually set dates are left alone. Rows
+    whose policy and date are already right are not rewritten.
+    progress(done, total, updated) is called after every chunk.
+    
+    Returns: Number of patients updated
+    """
+    first_id, last_id = get_connection().execute(
+        "SELECT MIN(patient_id), MAX(patient_id) FROM patients"
+    ).fetchone()
+    if first_id is None:
+        return 0
+    
+    query = f"""
+        UPDATE patients 
+        SET (retention_policy_id, retention_date) = ({POLICY_MATCH_SQL})
+        WHERE patient_id BETWEEN ? AND ?
+          AND key_version != ?
+          AND (retention_policy_id IS NOT NULL OR retention_date IS NULL)
+          AND (retention_policy_id, retention_date) IS NOT ({POLICY_MATCH_SQL})
+    """
+    
+    total = last_id - first_id + 1
+    count = 0
+    for start in range(first_id, last_id + 1, chunk_size):
+        end = min(start + chunk_size - 1, last_id)
+        with transaction() as conn:
+            count += conn.execute(query, (start, end, ERASED)).rowcount
+        if progress:
+            progress(end - first_id + 1, total, count)
+    
+    print(f"✅ Retention policies applied to {count} patients")
+    return count
 
 
 def check_expired_data():
@@ -291,24 +517,97 @@ def check_expired_data():
     Check for patients whose data retention period has expired
     Returns: List of patient IDs with expired data
     """
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
+    
+    today = datetime.now().strftime('%Y-%m-%d')
     
+    cursor.execute("""
+        SELECT patient_id, name, retention_date 
+        FROM patients 
+        WHERE retention_date IS NOT NULL 
+        AND retention_date <= ?
+    """, (today,))
+    
+    expired = cursor.fetchall()
+    return expired
+
+
+def retention_lag_days():
+    """
+    How far the sweeper is behind the retention policy
+    Returns: Days since the oldest still-present record expired (0 if none)
+    """
+    today = datetime.now().strftime('%Y-%m-%d')
+    # MIN over the partial retention_date index: one index seek
+    oldest = get_connection().execute("""
+        SELECT MIN(retention_date) FROM patients 
+        WHERE retention_date IS NOT NULL AND retention_date <= ?
+    """, (today,)).fetchone()[0]
+    if oldest is None:
+        return 0
+    return (datetime.strptime(today, '%Y-%m-%d') - datetime.strptime(oldest[:10], '%Y-%m-%d')).days
+
+
+def sweep_expired_data(chunk_size=RETENTION_CHUNK_SIZE, pause=RETENTION_PAUSE,
+                       progress=None, user_id=0, role='system'):
+    """
+    Delete expired patient records in small batches
+    Each batch is picked from the retention_date index, shreds the
+    records' data keys and deletes them in one short transaction, then
+    pauses so other writers aren't starved. One audit event is logged
+    per deleted patient.
+    progress(deleted, rows_per_sec) is called after every batch.
+    
+    Returns: Dictionary with deleted, seconds, rows_per_sec and lag_days
+    (how overdue the oldest record was when the sweep started)
+    """
+    conn = get_connection()
+    today = datetime.now().strftime('%Y-%m-%d')
+    lag_days = retention_lag_days()
+    started = time.perf_counter()
+    deleted = 0
+    
+    conn.execute("PRAGMA secure_delete = ON")
     try:
-        today = datetime.now().strftime('%Y-%m-%d')
-        
-        cursor.execute("""
-            SELECT patient_id, name, retention_date 
-            FROM patients 
-            WHERE retention_date IS NOT NULL 
-            AND retention_date <= ?
-        """, (today,))
-        
-        expired = cursor.fetchall()
-        return expired
-        
+        while True:
+            with transaction():
+                batch = conn.execute("""
+                    SELECT patient_id, data_key_id FROM patients 
+                    WHERE retention_date IS NOT NULL AND retention_date <= ?
+                    ORDER BY retention_date
+                    LIMIT ?
+                """, (today, chunk_size)).fetchall()
+                if not batch:
+                    break
+                
+                # Dependent data first: shred the records' data keys
+                conn.executemany("DELETE FROM data_keys WHERE key_id = ?",
+                                 [(key_id,) for _, key_id in batch if key_id is not None])
+                conn.executemany("DELETE FROM patients WHERE patient_id = ?",
+                                 [(patient_id,) for patient_id, _ in batch])
+            
+            for patient_id, _ in batch:
+                log_activity(user_id, role, 'retention_delete',
+                             f'Deleted expired patient {patient_id}',
+                             target_type=TARGET_PATIENT, target_id=patient_id)
+            
+            deleted += len(batch)
+            elapsed = time.perf_counter() - started
+            if progress:
+                progress(deleted, deleted / elapsed if elapsed > 0 else 0.0)
+            if len(batch) < chunk_size:
+                break
+            time.sleep(pause)
     finally:
-        conn.close()
+        conn.execute("PRAGMA secure_delete = OFF")
+    
+    elapsed = time.perf_counter() - started
+    return {
+        'deleted': deleted,
+        'seconds': elapsed,
+        'rows_per_sec': deleted / elapsed if elapsed > 0 else 0.0,
+        'lag_days': lag_days
+    }
 
 
 def delete_expired_data():
@@ -316,43 +615,68 @@ def delete_expired_data():
     Delete patient data that has exceeded retention period
     Returns: Number of records deleted
     """
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
-    try:
-        today = datetime.now().strftime('%Y-%m-%d')
-        
-        # Get count first
-        cursor.execute("""
-            SELECT COUNT(*) FROM patients 
-            WHERE retention_date IS NOT NULL 
-            AND retention_date <= ?
-        """, (today,))
-        count = cursor.fetchone()[0]
-        
-        # Delete expired records
-        cursor.execute("""
-            DELETE FROM patients 
-            WHERE retention_date IS NOT NULL 
-            AND retention_date <= ?
-        """, (today,))
-        
-        conn.commit()
-        print(f"✅ Deleted {count} expired patient records")
-        return count
-        
-    finally:
-        conn.close()
+    with _retention_lock:
+        result = sweep_expired_data()
+    print(f"✅ Deleted {result['deleted']} expired patient records "
+          f"({result['rows_per_sec']:.0f} rows/s)")
+    return result['deleted']
 
 
+_retention_lock = threading.Lock()
+_sweeper_stop = threading.Event()
+_sweeper_thread = None
+
+retention_status = {
+    'running': False,
+    'last_run': None,
+    'next_run': None,
+    'deleted': 0,
+    'rows_per_sec': 0.0,
+    'lag_days': 0,
+    'error': None
+}
+
+
+def start_retention_sweeper(interval=RETENTION_SWEEP_INTERVAL):
+    """
+    Run sweep_expired_data every `interval` seconds on a background thread
+    Returns: False if the sweeper is already running
+    """
+    global _sweeper_thread
+    if _sweeper_thread is not None and _sweeper_thread.is_alive():
+        return False
+    _sweeper_stop.clear()
+    
+    def run():
+        while not _sweeper_stop.is_set():
+            with _retention_lock:
+                retention_status.update(running=True, error=None)
+                try:
+                    result = sweep_expired_data()
+                    retention_status.update(
+                        deleted=result['deleted'],
+                        rows_per_sec=result['rows_per_sec'],
+                        lag_days=result['lag_days']
+                    )
+                except Exception as e:
+                    retention_status['error'] = str(e)
+                    print(f"❌ Retention sweep failed: {e}")
+                finally:
+                    retention_status.update(
+                        running=False,
+                        last_run=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        next_run=(datetime.now() + timedelta(seconds=interval)).strftime('%Y-%m-%d %H:%M:%S')
+                    )
+            _sweeper_stop.wait(interval)
+    
+    _sweeper_thread = threading.Thread(target=run, name="retention-sweeper", daemon=True)
+    _sweeper_thread.start()
+    return True
 
-def load_encryption_key():
-    """Load the encryption key"""
-    try:
-        return open('secret.key', 'rb').read()
-    except FileNotFoundError:
-        print("⚠️ Key file not found. Generating new key...")
-        return setup_encryption_key()
+
+def stop_retention_sweeper():
+    """Stop the background sweeper once the sweep in progress finishes"""
+    _sweeper_stop.set()
 
 
 def encrypt_data(data):
@@ -360,17 +684,8 @@ def encrypt_data(data):
     Encrypt data using Fernet
     Returns: Encrypted string
     """
-    if not data:
-        return None
-    
-    key = load_encryption_key()
-    fernet = Fernet(key)
-    
-    # Encrypt the data (must be bytes)
-    encrypted = fernet.encrypt(data.encode())
-    
-    # Return as string for database storage
-    return encrypted.decode()
+    # Cipher is cached by the key manager (no key file read per field)
+    return get_key_manager().encrypt(data)
 
 
 def decrypt_data(encrypted_data):
@@ -378,31 +693,58 @@ def decrypt_data(encrypted_data):
     Decrypt data using Fernet
     Returns: Original string
     """
-    if not encrypted_data:
-        return None
-    
-    key = load_encryption_key()
-    fernet = Fernet(key)
+    return get_key_manager().decrypt(encrypted_data)
+
+
+def encrypt_many(values):
+    """
+    Encrypt several fields at once
+    Returns: List of encrypted strings (None for empty values)
+    """
+    return get_key_manager().encrypt_many(values)
+
+
+def decrypt_many(values):
+    """
+    Decrypt several fields at once
+    Returns: List of original strings (None for empty values)
+    """
+    return get_key_manager().decrypt_many(values)
+
+
+def create_data_key(cursor):
+    """
+    Generate a data key and store it wrapped by the master key
+    Returns: (key_id, Fernet cipher for the new key)
+    """
+    data_key = Fernet.generate_key()
+    wrapped_key, kek_version = get_key_manager().wrap_key(data_key)
     
-    # Decrypt (convert string back to bytes first)
-    decrypted = fernet.decrypt(encrypted_data.encode())
+    cursor.execute("""
+        INSERT INTO data_keys (wrapped_key, kek_version)
+        VALUES (?, ?)
+    """, (wrapped_key, kek_version))
     
-    # Return as string
-    return decrypted.decode()
+    return cursor.lastrowid, Fernet(data_key)
 
 
-def encrypt_patient_data(patient_id):
+def encrypt_patient_data(patient_id, envelope=None):
     """
     Encrypt sensitive patient data (reversible)
     Stores encrypted version in database
+    Already-encrypted patients are left untouched
+    envelope=True encrypts with a per-record data key (default: ENVELOPE_ENCRYPTION)
+    Returns: True if encrypted, None if already encrypted, False if not found
     """
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
+    if envelope is None:
+        envelope = ENVELOPE_ENCRYPTION
     
-    try:
+    with transaction() as conn:
+        cursor = conn.cursor()
+        
         # Get patient data
         cursor.execute("""
-            SELECT name, contact, diagnosis 
+            SELECT name, contact, diagnosis, key_version 
             FROM patients 
             WHERE patient_id = ?
         """, (patient_id,))
@@ -411,62 +753,307 @@ def encrypt_patient_data(patient_id):
         if not patient:
             return False
         
-        name, contact, diagnosis = patient
+        name, contact, diagnosis, key_version = patient
         
-        # Encrypt sensitive fields
-        encrypted_name = encrypt_data(name)
-        encrypted_contact = encrypt_data(contact)
-        encrypted_diagnosis = encrypt_data(diagnosis)
+        if key_version != PLAINTEXT:
+            print(f"ℹ️ Patient {patient_id} is already encrypted")
+            return None
+        
+        # Encrypt sensitive fields with a new data key or the current master key
+        if envelope:
+            data_key_id, fernet = create_data_key(cursor)
+            key_version = ENVELOPE
+            encrypted_name, encrypted_contact, encrypted_diagnosis = [
+                fernet.encrypt(v.encode()).decode() if v else None
+                for v in (name, contact, diagnosis)
+            ]
+        else:
+            data_key_id = None
+            fernet, key_version = get_key_manager().current()
+            encrypted_name, encrypted_contact, encrypted_diagnosis = [
+                fernet.encrypt(v.encode()).decode() if v else None
+                for v in (name, contact, diagnosis)
+            ]
         
         # Update database with encrypted versions
-        # Add new columns if needed (or reuse existing ones)
+        # (refresh the contact mask and search indexes while the plaintext is still available)
         cursor.execute("""
             UPDATE patients 
-            SET name = ?, contact = ?, diagnosis = ?
+            SET name = ?, contact = ?, diagnosis = ?,
+                anonymized_contact = ?, key_version = ?, data_key_id = ?,
+                name_index = ?, contact_index = ?
             WHERE patient_id = ?
-        """, (encrypted_name, encrypted_contact, encrypted_diagnosis, patient_id))
+        """, (encrypted_name, encrypted_contact, encrypted_diagnosis,
+              mask_contact(contact), key_version, data_key_id,
+              name_index(name), contact_index(contact), patient_id))
         
-        conn.commit()
         print(f"✅ Patient {patient_id} data encrypted!")
         return True
-        
-    finally:
-        conn.close()
+
+
+def decrypt_fields(fields, key_version, wrapped_key=None):
+    """
+    Decrypt one row's fields according to its key_version
+    Returns: List of original strings
+    """
+    if key_version == PLAINTEXT:
+        return list(fields)
+    if key_version == ENVELOPE:
+        fernet = get_key_manager().unwrap_key(wrapped_key)
+        return [fernet.decrypt(v.encode()).decode() if v else None for v in fields]
+    return decrypt_many(fields)
 
 
 def decrypt_patient_data(patient_id):
     """
     Decrypt patient data for authorized viewing
+    Handles plaintext, master-key and envelope-encrypted rows
     Returns: Dictionary with decrypted data
     """
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
+    
+    cursor.execute("""
+        SELECT p.patient_id, p.name, p.contact, p.diagnosis, p.key_version,
+               k.wrapped_key
+        FROM patients p
+        LEFT JOIN data_keys k ON k.key_id = p.data_key_id
+        WHERE p.patient_id = ?
+    """, (patient_id,))
+    
+    patient = cursor.fetchone()
+    if not patient:
+        return None
+    
+    pid, encrypted_name, encrypted_contact, encrypted_diagnosis, key_version, wrapped_key = patient
+    
+    # Decrypt the data (plaintext rows are returned as stored)
+    name, contact, diagnosis = decrypt_fields(
+        [encrypted_name, encrypted_contact, encrypted_diagnosis], key_version, wrapped_key
+    )
+    decrypted_data = {
+        'patient_id': pid,
+        'name': name,
+        'contact': contact,
+        'diagnosis': diagnosis
+    }
+    
+    return decrypted_data
+
+
+def erase_patient(patient_id, erased_by_user_id):
+    """
+    Right to be forgotten: crypto-shred one patient
+    Destroys the patient's data key, which makes every copy of their
+    ciphertext (CSV exports, other databases) unreadable at O(1) cost, then
+    blanks the row. Database backups keep the wrapped data key until the
+    master key it was wrapped with is rotated out (jobs.py rotate). The
+    row itself is removed later by the background compaction.
     
+    Returns: True if the patient existed
+    """
+    conn = get_connection()
+    # Zero freed pages so the destroyed key can't be recovered from the file
+    conn.execute("PRAGMA secure_delete = ON")
     try:
-        cursor.execute("""
-            SELECT patient_id, name, contact, diagnosis 
-            FROM patients 
-            WHERE patient_id = ?
-        """, (patient_id,))
-        
-        patient = cursor.fetchone()
-        if not patient:
-            return None
-        
-        pid, encrypted_name, encrypted_contact, encrypted_diagnosis = patient
+        with transaction():
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT key_version, data_key_id 
+                FROM patients 
+                WHERE patient_id = ? AND key_version != ?
+            """, (patient_id, ERASED))
+            
+            patient = cursor.fetchone()
+            if not patient:
+                return False
+            
+            key_version, data_key_id = patient
+            
+            # 1. Destroy the key
+            if data_key_id is not None:
+                cursor.execute("DELETE FROM data_keys WHERE key_id = ?", (data_key_id,))
+            
+            # 2. Blank the row and mark it for compaction
+            cursor.execute("""
+                UPDATE patients 
+                SET name = '', contact = '', diagnosis = NULL,
+                    anonymized_name = NULL, anonymized_contact = NULL,
+                    name_index = NULL, contact_index = NULL,
+                    key_version = ?, data_key_id = NULL
+                WHERE patient_id = ?
+            """, (ERASED, patient_id))
+            
+            log_activity(erased_by_user_id, 'admin', 'erase_patient',
+                         f'Erased patient {patient_id}', durable=True,
+                         target_type=TARGET_PATIENT, target_id=patient_id)
+    finally:
+        conn.execute("PRAGMA secure_delete = OFF")
+    
+    if key_version != ENVELOPE:
+        print(f"⚠️ Patient {patient_id} had no data key - copies made outside the database are not shredded")
+    print(f"✅ Patient {patient_id} erased")
+    
+    start_compaction()
+    return True
+
+
+def compact_erased_patients(chunk_size=COMPACTION_CHUNK_SIZE):
+    """
+    Physically delete erased patient rows in small batches
+    Returns: Number of rows removed
+    """
+    conn = get_connection()
+    conn.execute("PRAGMA secure_delete = ON")
+    count = 0
+    
+    try:
+        while True:
+            with transaction():
+                deleted = conn.execute("""
+                    DELETE FROM patients 
+                    WHERE patient_id IN (SELECT patient_id FROM patients 
+                                         WHERE key_version = ? LIMIT ?)
+                """, (ERASED, chunk_size)).rowcount
+            count += deleted
+            if deleted < chunk_size:
+                break
         
-        # Decrypt the data
-        decrypted_data = {
-            'patient_id': pid,
-            'name': decrypt_data(encrypted_name),
-            'contact': decrypt_data(encrypted_contact),
-            'diagnosis': decrypt_data(encrypted_diagnosis)
-        }
+        # Move the zeroed pages out of the WAL into the main file
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.execute("PRAGMA secure_delete = OFF")
+    
+    return count
+
+
+_compaction_lock = threading.Lock()
+
+
+def start_compaction():
+    """Run compact_erased_patients on a background thread (one at a time)"""
+    if not _compaction_lock.acquire(blocking=False):
+        return False
+    
+    def run():
+        try:
+            compact_erased_patients()
+        except Exception as e:
+            print(f"❌ Compaction failed: {e}")
+        finally:
+            _compaction_lock.release()
+    
+    threading.Thread(target=run, name="erase-compaction", daemon=True).start()
+    return True
+
+
+def build_blind_indexes(chunk_size=INDEX_CHUNK_SIZE):
+    """
+    Fill name_index/contact_index for rows that don't have them yet
+    Plaintext rows are indexed with one set-based UPDATE per chunk;
+    encrypted rows are decrypted chunk by chunk (once, at build time).
+    
+    Returns: Number of rows indexed
+    """
+    conn = get_connection()
+    count = 0
+    
+    # 1. Plaintext rows: hash in SQL through the registered functions
+    last_id = conn.execute("SELECT MAX(patient_id) FROM patients").fetchone()[0] or 0
+    for start in range(1, last_id + 1, chunk_size):
+        with transaction():
+            count += conn.execute("""
+                UPDATE patients 
+                SET name_index = name_index(name), contact_index = contact_index(contact)
+                WHERE patient_id BETWEEN ? AND ?
+                  AND key_version = ? AND name_index IS NULL
+            """, (start, start + chunk_size - 1, PLAINTEXT)).rowcount
+    
+    # 2. Encrypted rows: decrypt to compute the index
+    after_id = 0
+    while True:
+        rows = conn.execute("""
+            SELECT p.patient_id, p.name, p.contact, p.key_version, k.wrapped_key
+            FROM patients p
+            LEFT JOIN data_keys k ON k.key_id = p.data_key_id
+            WHERE p.patient_id > ? AND p.name_index IS NULL
+              AND p.key_version NOT IN (?, ?)
+            ORDER BY p.patient_id
+            LIMIT ?
+        """, (after_id, PLAINTEXT, ERASED, chunk_size)).fetchall()
+        if not rows:
+            break
+        after_id = rows[-1][0]
         
-        return decrypted_data
+        updates = []
+        for patient_id, name, contact, key_version, wrapped_key in rows:
+            try:
+                name, contact = decrypt_fields([name, contact], key_version, wrapped_key)
+            except Exception:
+                print(f"⚠️ Patient {patient_id} can't be decrypted - not indexed")
+                continue
+            updates.append((name_index(name), contact_index(contact), patient_id))
         
-    finally:
-        conn.close()
+        with transaction():
+            count += conn.executemany("""
+                UPDATE patients 
+                SET name_index = ?, contact_index = ?
+                WHERE patient_id = ?
+            """, updates).rowcount
+    
+    print(f"✅ Indexed {count} patients")
+    return count
+
+
+def find_patients(role, name=None, contact=None, user_id=0):
+    """
+    Exact-match patient search that works on encrypted records
+    Looks up the blind indexes (HMAC of the normalized name / phone
+    number) through their SQLite indexes, so only the matching rows are
+    read - and for admins, decrypted. Every decrypted record is logged
+    as a durable decrypt_data event by user_id, like a single decrypt;
+    records no known key can decrypt are skipped.
+    
+    Returns: List of patient dictionaries for the given role
+    """
+    conditions = []
+    params = []
+    
+    if name:
+        conditions.append("name_index = ?")
+        params.append(name_index(name))
+    if contact:
+        conditions.append("contact_index = ?")
+        params.append(contact_index(contact))
+    if not conditions or None in params:
+        return []
+    
+    cursor = get_connection().cursor()
+    cursor.execute(f"""
+        SELECT patient_id FROM patients 
+        WHERE {' AND '.join(conditions)}
+        ORDER BY patient_id
+    """, params)
+    patient_ids = [row[0] for row in cursor.fetchall()]
+    
+    results = []
+    for patient_id in patient_ids:
+        data = get_patient_by_id(patient_id, role)
+        if data is None:
+            continue
+        if role == 'admin':
+            try:
+                data.update(decrypt_patient_data(patient_id))
+            except InvalidToken:
+                # Key no longer in the ring - skip the row, keep the search going
+                print(f"⚠️ Patient {patient_id} can't be decrypted with any known key")
+                continue
+            log_activity(user_id, role, 'decrypt_data',
+                         f'Decrypted patient {patient_id} (search)', durable=True,
+                         target_type=TARGET_PATIENT, target_id=patient_id)
+        results.append(data)
+    
+    return results
 
 
 # Test the functions
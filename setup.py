@@ -1,22 +1,32 @@
 # setup.py - Run this once to set up everything
 
-import sqlite3
-from database import create_tables, seed_users
+from database import get_connection, transaction
 from cryptography.fernet import Fernet
 
 def setup_database():
-    """Initialize database with all tables"""
+    """Initialize database with all tables (versioned migrations)"""
     print("📦 Setting up database...")
-    create_tables()
+    from migrations import run_migrations
+    run_migrations()
     print("✅ Tables created!")
 
 
+def check_query_plans():
+    """Report hot queries that no longer use their indexes (diagnostic only)"""
+    print("🔎 Checking query plans...")
+    from migrations import check_query_plans, QueryPlanError
+    try:
+        check_query_plans()
+        print("✅ Hot queries use their indexes")
+    except QueryPlanError as e:
+        print(f"⚠️ {e}")
+
+
 def setup_users():
     """Add default users"""
     print("👥 Setting up users...")
     
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     
     # Check if users already exist
     cursor.execute("SELECT COUNT(*) FROM users")
@@ -28,85 +38,36 @@ def setup_users():
         print("✅ Users added!")
     else:
         print(f"ℹ️ Users already exist ({count} users found)")
-    
-    conn.close()
 
 
 def add_test_patients():
     """Add test patient data"""
     print("🏥 Adding test patients...")
     
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
-    # Check if patients already exist
-    cursor.execute("SELECT COUNT(*) FROM patients")
-    count = cursor.fetchone()[0]
-    
-    if count == 0:
-        patients = [
-            ('John Doe', '0300-1234567', 'Diabetes'),
-            ('Jane Smith', '+92-321-9876543', 'Hypertension'),
-            ('Ali Khan', '03451234567', 'Flu'),
-            ('Sara Ahmed', '0333-7654321', 'Asthma'),
-            ('Ahmed Raza', '0345-9998877', 'Migraine')
-        ]
+    with transaction() as conn:
+        cursor = conn.cursor()
         
-        cursor.executemany("""
-            INSERT INTO patients (name, contact, diagnosis)
-            VALUES (?, ?, ?)
-        """, patients)
+        # Check if patients already exist
+        cursor.execute("SELECT COUNT(*) FROM patients")
+        count = cursor.fetchone()[0]
         
-        conn.commit()
-        print(f"✅ Added {len(patients)} test patients!")
-    else:
-        print(f"ℹ️ Patients already exist ({count} patients found)")
-    
-    conn.close()
-
-
-def add_gdpr_columns():
-    """Add GDPR-related columns (safe to run multiple times)"""
-    print("🔒 Adding GDPR columns...")
-    
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
-    # Get existing columns
-    cursor.execute("PRAGMA table_info(patients)")
-    existing_columns = [col[1] for col in cursor.fetchall()]
-    
-    columns_added = 0
-    
-    # Add consent_given column
-    if 'consent_given' not in existing_columns:
-        cursor.execute("""
-            ALTER TABLE patients 
-            ADD COLUMN consent_given INTEGER DEFAULT 0
-        """)
-        columns_added += 1
-        print("  ✅ Added consent_given column")
-    else:
-        print("  ℹ️ consent_given already exists")
-    
-    # Add retention_date column
-    if 'retention_date' not in existing_columns:
-        cursor.execute("""
-            ALTER TABLE patients 
-            ADD COLUMN retention_date TEXT
-        """)
-        columns_added += 1
-        print("  ✅ Added retention_date column")
-    else:
-        print("  ℹ️ retention_date already exists")
-    
-    if columns_added > 0:
-        conn.commit()
-        print(f"✅ Added {columns_added} GDPR columns!")
-    else:
-        print("✅ All GDPR columns already exist!")
-    
-    conn.close()
+        if count == 0:
+            patients = [
+                ('John Doe', '0300-1234567', 'Diabetes'),
+                ('Jane Smith', '+92-321-9876543', 'Hypertension'),
+                ('Ali Khan', '03451234567', 'Flu'),
+                ('Sara Ahmed', '0333-7654321', 'Asthma'),
+                ('Ahmed Raza', '0345-9998877', 'Migraine')
+            ]
+            
+            cursor.executemany("""
+                INSERT INTO patients (name, contact, diagnosis)
+                VALUES (?, ?, ?)
+            """, patients)
+            
+            print(f"✅ Added {len(patients)} test patients!")
+        else:
+            print(f"ℹ️ Patients already exist ({count} patients found)")
 
 
 def setup_encryption_key():
@@ -133,7 +94,7 @@ def main():
     print("="*50 + "\n")
     
     try:
-        # Step 1: Create database and tables
+        # Step 1: Create database and tables (versioned migrations)
         setup_database()
         
         # Step 2: Add default users
@@ -142,12 +103,17 @@ def main():
         # Step 3: Add test patients
         add_test_patients()
         
-        # Step 4: Add GDPR columns
-        add_gdpr_columns()
-        
-        # Step 5: Setup encryption
+        # Step 4: Setup encryption
         setup_encryption_key()
         
+        # Step 5: Masked columns and blind indexes for the test patients
+        from privacy import anonymize_all_patients, build_blind_indexes
+        anonymize_all_patients(incremental=True)
+        build_blind_indexes()
+        
+        # Step 6: Query plan diagnostic
+        check_query_plans()
+        
         print("\n" + "="*50)
         print("✅ SETUP COMPLETED SUCCESSFULLY!")
         print("="*50)